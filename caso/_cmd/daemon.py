@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import signal
+import sys
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+
+import caso.config
+import caso.manager
+
+opts = [
+    cfg.IntOpt(
+        "interval",
+        default=3600,
+        min=1,
+        help="Time (in seconds) between the start of two consecutive extractions "
+        "when running as a daemon. If an extraction takes longer, the next one "
+        "starts as soon as it finishes.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts, group="daemon")
+CONF.import_opt("memory_ttl", "caso.cache", group="cache")
+
+LOG = log.getLogger(__name__)
+
+# Default time that the caches are kept in memory between runs of the daemon
+MEMORY_TTL = 86400
+
+
+def set_defaults():
+    """Keep the caches in memory between runs, unless configured otherwise.
+
+    The caches are kept for at least two runs, so that they are reused by the
+    following one.
+    """
+    memory_ttl = max(MEMORY_TTL, 2 * CONF.daemon.interval)
+    CONF.set_default("memory_ttl", memory_ttl, group="cache")
+
+
+def serve(manager, stop):
+    """Run the manager periodically until stop is set.
+
+    :param manager: the cASO manager to run, reused between runs so that
+                    sessions, connections and caches are kept.
+    :param stop: threading.Event that stops the loop once set.
+    """
+    while not stop.is_set():
+        start = time.monotonic()
+        try:
+            manager.run()
+        except Exception:
+            # Keep on running, the next run will extract the missing records
+            LOG.exception("Cannot extract records, got the following exception:")
+        elapsed = time.monotonic() - start
+        LOG.info(f"Extraction finished in {elapsed:.0f} seconds")
+        stop.wait(max(0, CONF.daemon.interval - elapsed))
+
+
+def main():
+    """Run caso periodically, as a daemon."""
+    caso.config.parse_args(sys.argv)
+    log.setup(cfg.CONF, "caso")
+    set_defaults()
+
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        LOG.info(f"Got signal {signum}, stopping after the current extraction")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    manager = caso.manager.Manager()
+    serve(manager, stop)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Module containing the caches shared by the cASO extractors."""
+
+import json
+import os.path
+import threading
+import time
+
+from oslo_config import cfg
+from oslo_log import log
+
+from caso import utils
+
+opts = [
+    cfg.IntOpt(
+        "flavors_ttl",
+        default=0,
+        min=0,
+        help="Time (in seconds) that the flavors are kept in a cache stored in the "
+        "spool directory. Within this time the flavors are not listed again, and "
+        "deleted flavors are kept in the cache, so that servers using them are "
+        "still accounted correctly. Set to 0 to disable the persistent cache.",
+    ),
+    cfg.IntOpt(
+        "images_ttl",
+        default=0,
+        min=0,
+        help="Time (in seconds) that the image information is kept in a cache "
+        "stored in the spool directory. Set to 0 to disable the persistent cache.",
+    ),
+    cfg.IntOpt(
+        "users_ttl",
+        default=0,
+        min=0,
+        help="Time (in seconds) that the Keystone user names are kept in a cache "
+        "stored in the spool directory, including the users that could not be "
+        "found. Set to 0 to disable the persistent cache.",
+    ),
+    cfg.IntOpt(
+        "servers_ttl",
+        default=0,
+        min=0,
+        help="Time (in seconds) that the information of servers that did not "
+        "change is kept in a cache stored in the spool directory, so that it is "
+        "not requested again on every run. Set to 0 to disable the persistent "
+        "cache.",
+    ),
+    cfg.IntOpt(
+        "memory_ttl",
+        default=0,
+        min=0,
+        help="Time (in seconds) that the flavors, images, users and servers "
+        "whose cache is not stored in the spool directory are kept in memory "
+        "between runs of the same process, e.g. when running caso-daemon. Set "
+        "to 0 to get them again on every run.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts, group="cache")
+
+LOG = log.getLogger(__name__)
+
+_CACHES = []
+
+
+class Cache(object):
+    """A thread-safe key/value cache shared by all the extractors.
+
+    The cache can be filled at once with ``populate()`` or lazily with the
+    loader given to ``get()``. Values returned by the loader are always
+    stored, even if they are ``None``, so that missing objects are not
+    requested again.
+
+    If the cache has a name and the corresponding ``<name>_ttl`` option in the
+    ``[cache]`` section is set, its contents are stored in the spool directory
+    and reused by the following runs until they expire. Otherwise, named
+    caches are kept in memory for ``memory_ttl`` seconds, if set. Expired entries are
+    kept if they cannot be loaded again (e.g. the object has been deleted),
+    but only while they keep being requested: entries that expired are
+    dropped when the cache is loaded or stored.
+    """
+
+    def __init__(self, name=None):
+        """Initialize an empty cache, registering it to be reset on each run.
+
+        :param name: name of the cache, used to persist it.
+        """
+        self.name = name
+        self._lock = threading.RLock()
+        self._data = {}
+        self._populated = None
+        self._loaded = False
+        self._dirty = False
+        _CACHES.append(self)
+
+    @property
+    def persistent(self):
+        """Check if the cache is stored in the spool directory."""
+        if self.name is None:
+            return False
+        return bool(getattr(CONF.cache, f"{self.name}_ttl", 0))
+
+    @property
+    def ttl(self):
+        """Get the time to live of the cache entries, 0 if they do not expire."""
+        if self.name is None:
+            return 0
+        return getattr(CONF.cache, f"{self.name}_ttl", 0) or CONF.cache.memory_ttl
+
+    @property
+    def path(self):
+        """Get the file where the cache is persisted."""
+        return os.path.join(CONF.spooldir, "cache", f"{self.name}.json")
+
+    def _is_fresh(self, timestamp):
+        return not self.ttl or time.time() - timestamp < self.ttl
+
+    def _drop_expired(self):
+        expired = [
+            key
+            for key, (timestamp, _value) in self._data.items()
+            if not self._is_fresh(timestamp)
+        ]
+        for key in expired:
+            del self._data[key]
+        if expired:
+            self._dirty = True
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.persistent or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r") as fd:
+                data = json.load(fd)
+        except (OSError, ValueError) as e:
+            LOG.warning(f"Cannot load cache from '{self.path}', ignoring it: {e}")
+            return
+        self._populated = data.get("populated")
+        self._data.update(
+            {key: tuple(entry) for key, entry in data.get("entries", {}).items()}
+        )
+        self._drop_expired()
+
+    def _set(self, key, value, timestamp=None):
+        self._data[key] = (timestamp or time.time(), value)
+        self._dirty = True
+
+    def populate(self, loader):
+        """Fill the cache with the dictionary returned by loader.
+
+        The loader is only called if the cache was not populated yet, or if
+        the persisted contents have expired.
+
+        :param loader: callable returning a dictionary with the cache contents.
+        """
+        with self._lock:
+            self._load()
+            if self._populated is not None and self._is_fresh(self._populated):
+                return
+            now = time.time()
+            for key, value in loader().items():
+                self._set(key, value, now)
+            self._populated = now
+
+    def _store(self, key, value, stale_value):
+        if value is None and stale_value is not None:
+            # The object is gone, keep the information that we had
+            value = stale_value
+        self._set(key, value)
+        return value
+
+    def get(self, key, loader=None):
+        """Get a value from the cache, loading it if it is not there.
+
+        :param key: the key to look for.
+        :param loader: callable taking the key as argument, returning the
+                       value to store in the cache on a miss, or None if the
+                       object does not exist.
+        :returns: the cached value, or None if it is missing or expired and
+                  there is no loader.
+        """
+        with self._lock:
+            self._load()
+            timestamp, value = self._data.get(key, (None, None))
+            if timestamp is not None and self._is_fresh(timestamp):
+                return value
+        if loader is None:
+            return None
+        new_value = loader(key)
+        with self._lock:
+            return self._store(key, new_value, value)
+
+    def missing(self, keys):
+        """Get the keys that are not in the cache, or that have expired.
+
+        :param keys: iterable with the keys to check.
+        :returns: a set with the missing keys.
+        """
+        with self._lock:
+            self._load()
+            return {
+                key
+                for key in keys
+                if key not in self._data or not self._is_fresh(self._data[key][0])
+            }
+
+    def items(self):
+        """Get all the entries in the cache that did not expire.
+
+        :returns: a dictionary with the cache contents.
+        """
+        with self._lock:
+            self._load()
+            return {
+                key: value
+                for key, (timestamp, value) in self._data.items()
+                if self._is_fresh(timestamp)
+            }
+
+    def update(self, values):
+        """Store several values in the cache at once.
+
+        :param values: dictionary with the values to store, None meaning that
+                       the object does not exist.
+        """
+        with self._lock:
+            self._load()
+            for key, value in values.items():
+                _timestamp, stale_value = self._data.get(key, (None, None))
+                self._store(key, value, stale_value)
+
+    def flush(self):
+        """Store the cache contents in the spool directory, if persistent.
+
+        Expired entries are dropped, also from caches only kept in memory.
+        """
+        with self._lock:
+            if not self.ttl:
+                return
+            self._drop_expired()
+            if not (self.persistent and self._dirty):
+                return
+            data = {
+                "populated": self._populated,
+                "entries": self._data,
+            }
+            utils.makedirs(os.path.dirname(self.path))
+            utils.write_file(self.path, json.dumps(data))
+            self._dirty = False
+
+    def clear(self):
+        """Remove all the contents of the cache from memory."""
+        with self._lock:
+            self._data.clear()
+            self._populated = None
+            self._loaded = False
+            self._dirty = False
+
+
+def reset():
+    """Reset all the caches, so that a new run does not get stale data.
+
+    Caches with a TTL (persistent or in memory) keep their contents, as their
+    entries expire on their own, so that they are kept warm if several runs
+    happen in the same process.
+    """
+    for cache in _CACHES:
+        if not cache.ttl:
+            cache.clear()
+
+
+def flush():
+    """Store the contents of all the persistent caches."""
+    for cache in _CACHES:
+        try:
+            cache.flush()
+        except Exception as e:
+            LOG.warning(f"Cannot store cache '{cache.name}': {e}")
@@ -58,3 +58,9 @@ class LogstashConnectionError(CasoError):
     """An error with the Logstash server."""
 
     msg_fmt = "Cannot send data to logstash {host}:{port}, " "reason: {exception}"
+
+
+class InvalidShardError(CasoError):
+    """An error representing a wrong shard configuration."""
+
+    msg_fmt = "Shard index {index} must be lower than the shard count {count}."
@@ -53,3 +53,18 @@ class BaseProjectExtractor(object):
 
         This method should be overriden in a subclass.
         """
+
+    def iter_records(self, extract_from, extract_to):
+        """Iterate over the records for a project for the given period.
+
+        Extractors that can produce their records as they go should override
+        this method, so that records can be pushed before the whole extraction
+        ends. By default the records returned by ``extract`` are used.
+
+        :param extract_from: datetime.datetime object indicating the date to
+                             extract records from
+        :param extract_to: datetime.datetime object indicating the date to
+                           extract records to
+        :returns: An iterator over the accounting records
+        """
+        return iter(self.extract(extract_from, extract_to))
@@ -16,20 +16,33 @@
 
 """Module containing the manager for all extractors configured in cASO."""
 
+from concurrent import futures
 import datetime
+import hashlib
+import inspect
+import itertools
 import json
 import os.path
+import queue
 import sys
+import threading
 import warnings
 
 import dateutil.parser
+from dateutil import relativedelta
 from dateutil import tz
+from oslo_concurrency import lockutils
 from oslo_config import cfg
+from oslo_config import types
 from oslo_log import log
 import six
 
+from caso import cache
+from caso import exception
 from caso import keystone_client
 from caso import loading
+from caso import state
+from caso import utils
 
 cli_opts = [
     cfg.ListOpt(
@@ -79,6 +92,35 @@ cli_opts = [
         "it will extract records from the beginning of time. "
         "If no time zone is specified, UTC will be used.",
     ),
+    cfg.StrOpt(
+        "backfill-window",
+        default="none",
+        choices=[
+            ("none", "Extract the whole period at once."),
+            ("day", "Extract the period one day at a time."),
+            ("week", "Extract the period one week at a time."),
+            ("month", "Extract the period one month at a time."),
+        ],
+        help="Split the extraction period of each project in windows of this "
+        "size, that are extracted one after the other. The last run date is "
+        "updated after each window, so that an interrupted backfill resumes from "
+        "the last extracted window.",
+    ),
+    cfg.IntOpt(
+        "shard-count",
+        default=1,
+        min=1,
+        help="Number of cASO instances that share the extraction of the "
+        "projects. Each project is always assigned to the same instance, as "
+        "long as the number of instances does not change.",
+    ),
+    cfg.IntOpt(
+        "shard-index",
+        default=0,
+        min=0,
+        help="Index (starting at 0) of this instance among the ones sharing the "
+        "extraction of the projects (see shard-count).",
+    ),
     cfg.ListOpt(
         "extractor",
         default=["nova", "cinder", "neutron"],
@@ -90,12 +132,165 @@ cli_opts = [
     ),
 ]
 
+opts = [
+    cfg.IntOpt(
+        "extract_workers",
+        default=1,
+        min=1,
+        help="Number of worker threads used to extract records from several "
+        "projects concurrently. Records are returned in the same order "
+        "regardless of the number of workers.",
+    ),
+    cfg.BoolOpt(
+        "parallel_extractors",
+        default=False,
+        help="Run all the configured extractors concurrently for each project, "
+        "instead of running them one after the other.",
+    ),
+    cfg.Opt(
+        "extractor_intervals",
+        type=types.Dict(value_type=types.Integer(min=0)),
+        default={},
+        help="Minimum time (in seconds) between two extractions with the given "
+        "extractors, as a comma separated list of extractor:seconds pairs (e.g. "
+        "'cinder:86400,neutron:86400'). Extractors whose last run for a project "
+        "is more recent than that are skipped, so that expensive extractors can "
+        "run less often than the other ones. Extractors that are not listed run "
+        "every time. This is not used if extract-from is set.",
+    ),
+    cfg.StrOpt(
+        "lock_granularity",
+        default="global",
+        choices=[
+            ("global", "Only one cASO process can run at a time."),
+            (
+                "project",
+                "Several cASO processes can run at a time, each project is only "
+                "extracted by one of them.",
+            ),
+        ],
+        help="What is locked while records are extracted. With 'project', a "
+        "run started while the previous one is still extracting some projects "
+        "will skip those projects and extract all the other ones.",
+    ),
+    cfg.IntOpt(
+        "max_in_flight_records",
+        default=10000,
+        min=1,
+        help="Maximum number of records extracted concurrently (by several "
+        "extract workers or parallel extractors) that are waiting to be pushed. "
+        "Extraction is paused when this limit is reached, until the messengers "
+        "catch up. If both are enabled, each extract worker gets an equal share "
+        "of this limit for its parallel extractors.",
+    ),
+]
+
 CONF = cfg.CONF
 
 CONF.register_cli_opts(cli_opts)
+CONF.register_opts(opts)
 
 LOG = log.getLogger(__name__)
 
+# Runs started periodically (by cron or caso-daemon) may start slightly less
+# than a whole number of periods after the one that extracted an extractor
+EXTRACTOR_INTERVAL_SLACK = datetime.timedelta(minutes=1)
+
+BACKFILL_WINDOWS = {
+    "day": relativedelta.relativedelta(days=1),
+    "week": relativedelta.relativedelta(weeks=1),
+    "month": relativedelta.relativedelta(months=1),
+}
+
+# Marks the end of the items put in a queue by _iter_concurrently workers
+_DONE = object()
+
+
+class _Failure(object):
+    """Exception raised by a _iter_concurrently worker."""
+
+    def __init__(self, exc):
+        self.exc = exc
+
+
+class Checkpoint(object):
+    """Last run of an extractor for a project, yielded among the records.
+
+    The last run must only be stored once all the records yielded before it
+    have been pushed, using ``Manager.write_checkpoint``. A checkpoint without
+    an extractor marks the end of the records of a locked project, whose lock
+    is released then.
+    """
+
+    def __init__(self, project, extractor=None, date=None):
+        """Initialize a checkpoint for a project and extractor."""
+        self.project = project
+        self.extractor = extractor
+        self.date = date
+
+
+def _iter_concurrently(iterables, max_workers, max_in_flight):
+    """Consume several iterables concurrently, yielding their items in order.
+
+    Each iterable is consumed in a worker thread that puts its items in a
+    bounded queue, so that workers block when the consumer falls behind. An
+    iterable is only started once the consumer is done with the one
+    ``max_workers`` places before it, so that at most ``max_workers`` queues
+    hold items and at most (approximately) ``max_in_flight`` items are held at
+    once, however many iterables there are. Items are yielded in the same
+    order as if the iterables were consumed one after the other. Exceptions
+    raised by the iterables are raised in the consumer, and the workers stop
+    as soon as the consumer does.
+    """
+    iterables = list(iterables)
+    maxsize = max(1, max_in_flight // max_workers)
+    queues = [queue.Queue(maxsize=maxsize) for _ in iterables]
+    stop = threading.Event()
+
+    def put(q, item):
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+            except queue.Full:
+                continue
+            return True
+        return False
+
+    def work(iterable, q):
+        try:
+            if stop.is_set():
+                return
+            for item in iterable:
+                if not put(q, item):
+                    return
+        except BaseException as e:
+            put(q, _Failure(e))
+        else:
+            put(q, _DONE)
+        finally:
+            # Stop the workers of nested iterables (e.g. parallel extractors)
+            if inspect.isgenerator(iterable):
+                iterable.close()
+
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for iterable, q in zip(iterables[:max_workers], queues):
+            executor.submit(work, iterable, q)
+        try:
+            for i, q in enumerate(queues):
+                item = q.get()
+                while item is not _DONE:
+                    if isinstance(item, _Failure):
+                        raise item.exc
+                    yield item
+                    item = q.get()
+                # This queue is empty now, start the next pending iterable
+                following = i + max_workers
+                if following < len(iterables):
+                    executor.submit(work, iterables[following], queues[following])
+        finally:
+            # Do not keep on extracting if the consumer stopped or failed
+            stop.set()
+
 
 class Manager(object):
     """A manager for the configured extractors.
@@ -104,32 +299,89 @@ class Manager(object):
     last time the extractor was called (or from a given date).
     """
 
-    def __init__(self):
-        """Initialize a extractor manager, loading all configured extractors."""
+    def __init__(self, lock_path=None):
+        """Initialize a extractor manager, loading all configured extractors.
+
+        :param lock_path: directory for the lock files, used if locks are
+                          taken per project.
+        """
+        if CONF.shard_index >= CONF.shard_count:
+            raise exception.InvalidShardError(
+                index=CONF.shard_index, count=CONF.shard_count
+            )
+        # Parse the intervals now, so that wrong values fail before extracting
+        CONF.extractor_intervals
+
         extractors = [
             (i, loading.get_available_extractors()[i]) for i in CONF.extractor
         ]
         self.extractors = extractors
+        self.lock_path = lock_path
         self.last_run_base = os.path.join(CONF.spooldir, "lastrun")
+        self._project_locks = {}
+        self._project_locks_lock = threading.Lock()
+
+        self.state = None
+        if CONF.state_backend == "sqlite":
+            self.state = state.SQLiteStore(os.path.join(CONF.spooldir, "state.db"))
+            extractor_names = set(loading.get_available_extractor_names())
+            extractor_names.update(CONF.extractor)
+            self.state.import_files(self.last_run_base, extractor_names)
 
         self._voms_map = {}
         self.keystone = self._get_keystone_client()
 
     @property
     def projects(self):
-        """Get list of configured projects."""
+        """Get list of configured projects.
+
+        All the projects are listed at once and reused during the whole run.
+        If several instances share the extraction, only the projects assigned
+        to this instance are returned.
+        """
         projects = CONF.projects
-        aux = [i.id for i in self.keystone.projects.list(tags=CONF.caso_tag)]
-        return set(projects + aux)
+        all_projects = keystone_client.get_projects(self.keystone)
+        aux = [
+            project_id
+            for project_id, project in all_projects.items()
+            if CONF.caso_tag in project.get("tags", [])
+        ]
+        return {project for project in projects + aux if self._in_shard(project)}
+
+    @staticmethod
+    def _in_shard(project):
+        """Check if a project is assigned to this instance.
+
+        Projects are assigned with a stable hash, so that all the instances
+        agree on the assignment without talking to each other.
+        """
+        if CONF.shard_count == 1:
+            return True
+        digest = hashlib.sha256(project.encode("utf-8")).hexdigest()
+        return int(digest, 16) % CONF.shard_count == CONF.shard_index
 
     def _get_keystone_client(self):
         """Get a Keystone Client to get the projects that we will use."""
         client = keystone_client.get_client(CONF, system_scope="all")
         return client
 
-    def get_lastrun(self, project):
-        """Get lastrun file for a given project."""
-        lfile = f"{self.last_run_base}.{project}"
+    def _get_lastrun_file(self, project, extractor=None):
+        if extractor is None:
+            return f"{self.last_run_base}.{project}"
+        return f"{self.last_run_base}.{project}.{extractor}"
+
+    def get_lastrun(self, project, extractor=None):
+        """Get lastrun file for a given project.
+
+        :param extractor: if set, get the lastrun for this extractor, falling
+                          back to the one for the whole project.
+        """
+        if self.state is not None:
+            return self._get_stored_lastrun(project, extractor)
+
+        lfile = self._get_lastrun_file(project, extractor)
+        if extractor is not None and not os.path.exists(lfile):
+            lfile = self._get_lastrun_file(project)
         date = "1970-01-01"
 
         if os.path.exists(lfile):
@@ -146,13 +398,64 @@ class Manager(object):
             LOG.debug(f"Got '{date}' from lastrun file '{lfile}'")
         return date
 
-    def write_lastrun(self, project):
-        """Write a lastrun file for a given project."""
+    def _get_stored_lastrun(self, project, extractor=None):
+        """Get the lastrun for a given project from the state store."""
+        date = self.state.get(project, extractor)
+        if date is None and extractor is not None:
+            date = self.state.get(project)
+        if date is None:
+            date = "1970-01-01"
+            LOG.info(f"No lastrun found in '{self.state.path}', using '{date}'")
+        return dateutil.parser.parse(date)
+
+    def write_lastrun(self, project, date=None, extractor=None):
+        """Write a lastrun file for a given project.
+
+        :param date: date to write, if not set use the current date.
+        :param extractor: if set, write the lastrun for this extractor only.
+        """
         if CONF.dry_run:
             return
-        lfile = f"{self.last_run_base}.{project}"
-        with open(lfile, "w") as fd:
-            fd.write(str(datetime.datetime.now(tz.tzutc())))
+        if date is None:
+            date = datetime.datetime.now(tz.tzutc())
+        if self.state is not None:
+            self.state.set(project, date, extractor=extractor)
+            return
+        lfile = self._get_lastrun_file(project, extractor)
+        utils.write_file(lfile, str(date), mode=0o644)
+
+    def write_checkpoint(self, checkpoint, pushed=True):
+        """Store the last run given by a checkpoint.
+
+        :param checkpoint: a ``Checkpoint`` yielded by ``iter_records``.
+        :param pushed: whether the records yielded before the checkpoint were
+                       pushed. If not, the last run is not stored, but the lock
+                       of the project is released anyway.
+        """
+        if checkpoint.extractor is None:
+            self._release_project_lock(checkpoint.project)
+        elif pushed:
+            self.write_lastrun(
+                checkpoint.project, checkpoint.date, extractor=checkpoint.extractor
+            )
+
+    def release_locks(self):
+        """Release the locks of the projects whose end was not reached.
+
+        This must be called once the records given by ``iter_records`` are
+        consumed, even if there was an error, as the lock of a project is only
+        released when its last checkpoint is written.
+        """
+        with self._project_locks_lock:
+            projects = list(self._project_locks)
+        for project in projects:
+            self._release_project_lock(project)
+
+    def _release_project_lock(self, project):
+        with self._project_locks_lock:
+            lock = self._project_locks.pop(project, None)
+        if lock is not None:
+            lock.release()
 
     @property
     def voms_map(self):
@@ -195,9 +498,13 @@ class Manager(object):
 
     def get_project_vo(self, project_id):
         """Get the VO where the project should be mapped."""
-        project = self.keystone.projects.get(project_id)
-        project.get()
-        vo = project.to_dict().get(CONF.vo_property, None)
+        project = keystone_client.get_project(self.keystone, project_id)
+        if project is None:
+            # Not listed (e.g. the project name is used instead of the ID)
+            project = self.keystone.projects.get(project_id)
+            project.get()
+            project = project.to_dict()
+        vo = project.get(CONF.vo_property, None)
         if vo is None:
             LOG.warning(
                 f"No mapping could be found for project '{project_id}' in the "
@@ -228,6 +535,28 @@ class Manager(object):
         lastrun parameter. If CONF.extract_to is present, it will be used
         instead of the extract_to parameter
         """
+        records = []
+        try:
+            for record in self.iter_records():
+                if isinstance(record, Checkpoint):
+                    self.write_checkpoint(record)
+                else:
+                    records.append(record)
+        finally:
+            self.release_locks()
+        return records
+
+    def iter_records(self):
+        """Iterate over the records from given date, project by project.
+
+        This works as ``get_records``, but records are yielded as soon as the
+        extractors produce them, so that they do not need to be held in memory
+        all at once. The last runs of the extractors are not stored, but
+        yielded as ``Checkpoint`` objects after their records, so that they
+        can be stored once those records are pushed. If locks are taken per
+        project, they are held until the last checkpoint of the project is
+        written, and ``release_locks`` must be called at the end.
+        """
         now = datetime.datetime.now(tz.tzutc())
         extract_to = CONF.extract_to or now
 
@@ -245,57 +574,202 @@ class Manager(object):
             )
             extract_to = now
 
-        all_records = []
-        for project in self.projects:
-            LOG.info(f"Extracting records for project '{project}'")
+        # Do not reuse data cached by the extractors in a previous run
+        cache.reset()
+
+        projects = sorted(self.projects)
+        results = (self._iter_project(project, extract_to, now) for project in projects)
+        if CONF.extract_workers > 1 and len(projects) > 1:
+            records = _iter_concurrently(
+                results, CONF.extract_workers, CONF.max_in_flight_records
+            )
+        else:
+            records = itertools.chain.from_iterable(results)
+        yield from records
 
-            vo = self.get_project_vo(project)
+        cache.flush()
 
-            extract_from = CONF.extract_from or self.get_lastrun(project)
-            if isinstance(extract_from, six.string_types):
-                extract_from = dateutil.parser.parse(extract_from)
-            if extract_from.tzinfo is None:
-                extract_from = extract_from.replace(tzinfo=tz.tzutc())
+    def _iter_project(self, project, extract_to, now):
+        """Iterate over the records of a project with all the extractors.
 
-            if extract_from >= now:
-                LOG.error(
-                    "Cannot extract records from the future, please "
-                    "check the extract-from parameter or the last run "
-                    f"file for the project {project}!"
-                    f"(extract-from: {extract_from})"
+        This method is safe to be called concurrently for different projects.
+        If locks are taken per project, projects that are being extracted by
+        another process are skipped, and the lock is held until the last
+        checkpoint of the project is written, once its records are pushed.
+        """
+        lock = None
+        if CONF.lock_granularity == "project":
+            lock = lockutils.external_lock(
+                f"caso_project_{project}", lock_path=self.lock_path
+            )
+            if not lock.acquire(blocking=False):
+                LOG.warning(
+                    f"Project '{project}' is being extracted by another cASO "
+                    "process, skipping it"
                 )
-                sys.exit(1)
-
-            record_count = 0
-            for extractor_name, extractor_cls in self.extractors:
-                LOG.debug(
-                    f"Extractor {extractor_name}: extracting records "
-                    f"for project {project} "
-                    f"({extract_from} to {extract_to})"
+                return
+            with self._project_locks_lock:
+                self._project_locks[project] = lock
+            if self.state is not None:
+                # Another process may have extracted the project meanwhile
+                self.state.refresh(project)
+
+        try:
+            yield from self._iter_project_records(project, extract_to, now)
+        except BaseException:
+            if lock is not None:
+                self._release_project_lock(project)
+            raise
+        if lock is not None:
+            yield Checkpoint(project)
+
+    def _iter_project_records(self, project, extract_to, now):
+        """Iterate over the records of a project with all the extractors."""
+        LOG.info(f"Extracting records for project '{project}'")
+
+        vo = self.get_project_vo(project)
+
+        extract_args = [
+            (extractor_name, extractor_cls, project, vo, extract_to, now)
+            for extractor_name, extractor_cls in self.extractors
+        ]
+        results = (self._iter_extractor_windows(*args) for args in extract_args)
+        if CONF.parallel_extractors and len(extract_args) > 1:
+            # Projects extracted concurrently share the records in flight
+            max_in_flight = CONF.max_in_flight_records // CONF.extract_workers
+            records = _iter_concurrently(results, len(extract_args), max_in_flight)
+        else:
+            records = itertools.chain.from_iterable(results)
+
+        record_count = 0
+        for record in records:
+            if not isinstance(record, Checkpoint):
+                record_count += 1
+            yield record
+
+        LOG.info(
+            f"Extracted {record_count} records in total for "
+            f"project '{project}' (until {extract_to})"
+        )
+
+    def _get_extract_from(self, project, extractor_name, now):
+        """Get the date to extract records from for a project and extractor."""
+        extract_from = CONF.extract_from or self.get_lastrun(project, extractor_name)
+        if isinstance(extract_from, six.string_types):
+            extract_from = dateutil.parser.parse(extract_from)
+        if extract_from.tzinfo is None:
+            extract_from = extract_from.replace(tzinfo=tz.tzutc())
+
+        if extract_from >= now:
+            LOG.error(
+                "Cannot extract records from the future, please "
+                "check the extract-from parameter or the last run "
+                f"file for the project {project}!"
+                f"(extract-from: {extract_from})"
+            )
+            sys.exit(1)
+        return extract_from
+
+    def _iter_extractor_windows(
+        self, extractor_name, extractor_cls, project, vo, extract_to, now
+    ):
+        """Iterate over the records of a project with a single extractor.
+
+        The period since the last run of the extractor is extracted window by
+        window. A checkpoint with the new last run of the extractor is only
+        yielded once a window is extracted without errors, so that failed
+        windows are extracted again on the next run, without affecting the
+        other extractors.
+        """
+        extract_from = self._get_extract_from(project, extractor_name, now)
+        if not self._is_due(extractor_name, extract_from, now):
+            LOG.debug(
+                f"Extractor {extractor_name}: skipping project '{project}', "
+                f"its last run ({extract_from}) is too recent"
+            )
+            return
+        for window_from, window_to in self._get_windows(extract_from, extract_to):
+            ok = yield from self._iter_extractor(
+                extractor_name, extractor_cls, project, vo, window_from, window_to
+            )
+            if not ok:
+                LOG.warning(
+                    f"Extractor {extractor_name}: records for project "
+                    f"'{project}' will be extracted again from {window_from}"
                 )
-                try:
-                    extractor = extractor_cls(project, vo)
-                    records = extractor.extract(extract_from, extract_to)
-                    current_count = len(records)
-                    record_count += current_count
-                    all_records.extend(records)
-
-                    LOG.debug(
-                        f"Extractor {extractor_name}: extracted "
-                        f"{current_count} records for project "
-                        f"'{project}' "
-                        f"({extract_from} to {extract_to})"
-                    )
-                except Exception:
-                    LOG.exception(
-                        f"Extractor {extractor_name}: cannot "
-                        f"extract records for '{project}', got "
-                        "the following exception: "
-                    )
-            LOG.info(
-                f"Extracted {record_count} records in total for "
-                f"project '{project}' "
-                f"({extract_from} to {extract_to})"
+                return
+            if window_to < extract_to:
+                # Checkpoint, so that an interrupted backfill is resumed here
+                yield Checkpoint(project, extractor_name, window_to)
+        # Not the current date, as records may have changed since extract_to
+        yield Checkpoint(project, extractor_name, extract_to)
+
+    @staticmethod
+    def _is_due(extractor_name, extract_from, now):
+        """Check if the minimum interval of an extractor has elapsed.
+
+        The last run is the start of the run that extracted it, so the interval
+        is measured between the starts of the runs, and does not drift with the
+        time that the extraction takes.
+
+        :param extract_from: last run of the extractor for the project.
+        """
+        if CONF.extract_from:
+            return True
+        interval = CONF.extractor_intervals.get(extractor_name, 0)
+        interval = datetime.timedelta(seconds=interval)
+        return now - extract_from + EXTRACTOR_INTERVAL_SLACK >= interval
+
+    @staticmethod
+    def _get_windows(extract_from, extract_to):
+        """Split the extraction period in windows, as per CONF.backfill_window."""
+        step = BACKFILL_WINDOWS.get(CONF.backfill_window)
+        if step is None:
+            return [(extract_from, extract_to)]
+
+        windows = []
+        window_from = extract_from
+        while window_from < extract_to:
+            window_to = min(window_from + step, extract_to)
+            windows.append((window_from, window_to))
+            window_from = window_to
+        return windows
+
+    def _iter_extractor(
+        self, extractor_name, extractor_cls, project, vo, extract_from, extract_to
+    ):
+        """Iterate over the records of a project with a single extractor.
+
+        Errors are logged and the iteration stops, so that a failing extractor
+        does not affect the other ones. Records yielded before the error are
+        kept.
+
+        :returns: (as the generator return value) whether the extraction
+                  succeeded.
+        """
+        LOG.debug(
+            f"Extractor {extractor_name}: extracting records "
+            f"for project {project} "
+            f"({extract_from} to {extract_to})"
+        )
+        record_count = 0
+        try:
+            extractor = extractor_cls(project, vo)
+            for record in extractor.iter_records(extract_from, extract_to):
+                record_count += 1
+                yield record
+        except Exception:
+            LOG.exception(
+                f"Extractor {extractor_name}: cannot "
+                f"extract records for '{project}', got "
+                "the following exception: "
             )
-            self.write_lastrun(project)
-        return all_records
+            return False
+
+        LOG.debug(
+            f"Extractor {extractor_name}: extracted "
+            f"{record_count} records for project "
+            f"'{project}' "
+            f"({extract_from} to {extract_to})"
+        )
+        return True
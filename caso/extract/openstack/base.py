@@ -26,6 +26,7 @@ import novaclient.client
 from oslo_config import cfg
 from oslo_log import log
 
+from caso import cache
 from caso.extract import base
 from caso import keystone_client
 
@@ -40,12 +41,21 @@ opts = [
         "there are several defined in the OpenStack site. "
         "Defaults to None.",
     ),
+    cfg.BoolOpt(
+        "prefetch_users",
+        default=False,
+        help="Get all the Keystone users (one listing per domain) once per run, "
+        "instead of requesting each user when it is found in a record.",
+    ),
 ]
 
 CONF.register_opts(opts)
 
 LOG = log.getLogger(__name__)
 
+# User names are shared by all the extractors and projects
+USERS = cache.Cache("users")
+
 
 class BaseOpenStackExtractor(base.BaseProjectExtractor):
     """Base OpenStack Extractor that all other extractors should inherit from."""
@@ -57,6 +67,9 @@ class BaseOpenStackExtractor(base.BaseProjectExtractor):
         self.keystone = self._get_keystone_client()
         self.project_id = self._get_project_id()
 
+        if CONF.prefetch_users:
+            USERS.populate(self._get_keystone_users)
+
         self.vo = vo
 
         class Users:
@@ -77,7 +90,13 @@ class BaseOpenStackExtractor(base.BaseProjectExtractor):
                 if key is None:
                     return None
                 if key not in self._users:
-                    self._users[key] = self.parent._get_keystone_user(key)
+                    try:
+                        user = USERS.get(key, self.parent._get_keystone_user)
+                    except Exception as e:
+                        # Do not remember the error, it may be temporary
+                        LOG.warning(f"Cannot get user {key}: {e}")
+                        return None
+                    self._users[key] = user
                 return self._users.get(key, None)
 
         # Membership in keystone can be direct (a user belongs to a project) or
@@ -85,8 +104,13 @@ class BaseOpenStackExtractor(base.BaseProjectExtractor):
         # will build this aftewards
         self.users = Users(self)
 
-    def _get_keystone_session(self):
-        """Get a Keystone session for the configured project in the object."""
+    def _get_keystone_session(self, system_scope=None):
+        """Get a Keystone session for the configured project in the object.
+
+        :param system_scope: if set, get a system scoped session instead.
+        """
+        if system_scope is not None:
+            return keystone_client.get_session(CONF, None, system_scope=system_scope)
         session = keystone_client.get_session(CONF, self.project)
         return session
 
@@ -110,18 +134,40 @@ class BaseOpenStackExtractor(base.BaseProjectExtractor):
         session = self._get_keystone_session()
         return neutronclient.v2_0.client.Client(session=session)
 
-    def _get_nova_client(self):
-        """Get a nova client with a keystone session."""
+    def _get_nova_client(self, version=2, system_scope=None):
+        """Get a nova client with a keystone session.
+
+        :param version: Compute API (micro)version to use.
+        :param system_scope: if set, use a system scoped session.
+        """
         region_name = CONF.region_name
-        session = self._get_keystone_session()
-        return novaclient.client.Client(2, session=session, region_name=region_name)
+        session = self._get_keystone_session(system_scope=system_scope)
+        return novaclient.client.Client(
+            version, session=session, region_name=region_name
+        )
 
     def _get_project_id(self):
         """Get the project ID from the project in the object."""
+        project = keystone_client.get_project(self.keystone, self.project)
+        if project is not None:
+            return project["id"]
         return self.keystone.projects.get(self.project).id
 
+    def _get_keystone_users(self):
+        """Get the Keystone username for all the users, for all the domains."""
+        users = {}
+        for domain in self.keystone.domains.list():
+            for user in self.keystone.users.list(domain=domain.id):
+                users[user.id] = user.name
+        return users
+
     def _get_keystone_user(self, uuid):
-        """Get the Keystone username for a given uuid."""
+        """Get the Keystone username for a given uuid.
+
+        :returns: the username, or None if the user cannot be found or we are
+                  not allowed to get it. Other errors (e.g. timeouts) are
+                  raised, so that the user is not cached as missing.
+        """
         try:
             user = self.keystone.users.get(user=uuid)
             return user.name
@@ -129,9 +175,8 @@ class BaseOpenStackExtractor(base.BaseProjectExtractor):
             LOG.error(f"Unauthorized to get user {uuid}")
             LOG.exception(e)
             return None
-        except Exception as e:
-            LOG.debug(f"Exception while getting user {uuid}")
-            LOG.exception(e)
+        except keystoneauth1.exceptions.http.NotFound:
+            LOG.debug(f"User {uuid} could not be found")
             return None
 
     # FIXME(aloga): this has to go inside a record
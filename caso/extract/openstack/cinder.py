@@ -102,7 +102,18 @@ class CinderExtractor(base.BaseOpenStackExtractor):
         return volumes
 
     def extract(self, extract_from, extract_to):
-        """Extract records for a project from given date querying cinder.
+        """Extract records for a project from given date.
+
+        :param extract_from: datetime.datetime object indicating the date to
+                             extract records from
+        :param extract_to: datetime.datetime object indicating the date to
+                           extract records to
+        :returns: A list of storage records, as given by ``iter_records``
+        """
+        return list(self.iter_records(extract_from, extract_to))
+
+    def iter_records(self, extract_from, extract_to):
+        """Iterate over the records for a project for the given period.
 
         This method will get information from cinder.
 
@@ -110,7 +121,7 @@ class CinderExtractor(base.BaseOpenStackExtractor):
                              extract records from
         :param extract_to: datetime.datetime object indicating the date to
                            extract records to
-        :returns: A list of storage records
+        :returns: An iterator over the storage records
         """
         # Some API calls do not expect a TZ, so we have to remove the timezone
         # from the dates. We assume that all dates coming from upstream are
@@ -118,12 +129,7 @@ class CinderExtractor(base.BaseOpenStackExtractor):
         extract_from = extract_from.replace(tzinfo=None)
         extract_to = extract_to.replace(tzinfo=None)
 
-        # Our storage records
-        self.str_records = {}
-
         volumes = self._get_volumes(extract_from)
 
         for vol in volumes:
-            self.str_records[vol.id] = self._build_record(vol, extract_from, extract_to)
-
-        return list(self.str_records.values())
+            yield self._build_record(vol, extract_from, extract_to)
@@ -69,7 +69,18 @@ class NeutronExtractor(base.BaseOpenStackExtractor):
         return ips
 
     def extract(self, extract_from, extract_to):
-        """Extract records for a project from given date querying nova.
+        """Extract records for a project from given date.
+
+        :param extract_from: datetime.datetime object indicating the date to
+                             extract records from
+        :param extract_to: datetime.datetime object indicating the date to
+                           extract records to
+        :returns: A list of IP records, as given by ``iter_records``
+        """
+        return list(self.iter_records(extract_from, extract_to))
+
+    def iter_records(self, extract_from, extract_to):
+        """Iterate over the records for a project for the given period.
 
         This method will get information from nova.
 
@@ -78,7 +89,7 @@ class NeutronExtractor(base.BaseOpenStackExtractor):
                              extract records from
         :param extract_to: datetime.datetime object indicating the date to
                            extract records to
-        :returns: A list of records.
+        :returns: An iterator over the IP records.
         """
         # Some API calls do not expect a TZ, so we have to remove the timezone
         # from the dates. We assume that all dates coming from upstream are
@@ -86,8 +97,6 @@ class NeutronExtractor(base.BaseOpenStackExtractor):
         extract_from = extract_from.replace(tzinfo=None)
         extract_to = extract_to.replace(tzinfo=None)
 
-        self.ip_records = {}
-
         floating_ips = self._get_floating_ips()
 
         # Auxiliary variables to count ips
@@ -114,8 +123,4 @@ class NeutronExtractor(base.BaseOpenStackExtractor):
                 if count == 0:
                     continue
 
-                self.ip_records[user_id] = self._build_ip_record(
-                    user_id, count, ip_version
-                )
-
-        return list(self.ip_records.values())
+                yield self._build_ip_record(user_id, count, ip_version)
@@ -16,16 +16,23 @@
 
 """Module containing the OpenStack Compute (Nova) record extractor."""
 
+from concurrent import futures
+import itertools
 import operator
+import threading
 
 import dateutil.parser
 from dateutil.relativedelta import relativedelta
 from dateutil.rrule import MONTHLY
 from dateutil.rrule import rrule
+import glanceclient.exc
+from novaclient import api_versions
 import novaclient.exceptions
+from novaclient.v2 import servers as nova_servers
 from oslo_config import cfg
 from oslo_log import log
 
+from caso import cache
 from caso.extract.openstack import base
 from caso import record
 from datetime import datetime
@@ -72,15 +79,114 @@ benchmark_opts = [
     ),
 ]
 
+opts = [
+    cfg.BoolOpt(
+        "nova_embedded_flavors",
+        default=False,
+        help="Use the flavor information (vcpus, memory, disk and extra specs) "
+        "embedded in the server, instead of getting the flavors from the "
+        "compute API. This requires compute API microversion 2.47 or newer, "
+        "and works for deleted or private flavors. If the compute API does "
+        "not support it, flavors are requested as usual.",
+    ),
+    cfg.BoolOpt(
+        "nova_all_tenants",
+        default=False,
+        help="List the servers of all the projects at once, instead of listing "
+        "them for each project. This requires a system scoped role that is "
+        "allowed to list servers for all projects in the compute API.",
+    ),
+    cfg.BoolOpt(
+        "nova_all_tenants_usages",
+        default=False,
+        help="Get the usages of all the projects at once, instead of getting "
+        "them for each project. This requires a system scoped role that is "
+        "allowed to get the usages for all projects in the compute API. It is "
+        "not used if backfill-window is set, as each project may be extracted "
+        "in different windows.",
+    ),
+    cfg.IntOpt(
+        "nova_api_workers",
+        default=8,
+        min=1,
+        help="Maximum number of concurrent requests used to get the servers "
+        "and images that are not listed. The requests of all the projects "
+        "being extracted share this limit.",
+    ),
+]
+
 CONF = cfg.CONF
 
 CONF.import_opt("region_name", "caso.extract.openstack")
 CONF.import_opt("site_name", "caso.extract.base")
+CONF.import_opt("backfill_window", "caso.extract.manager")
+CONF.register_opts(opts)
 CONF.register_opts(benchmark_opts, group="benchmark")
 CONF.register_opts(accelerator_opts, group="accelerator")
 
 LOG = log.getLogger(__name__)
 
+# Flavors and images are shared by all the projects, so we get them only once
+# per run (or less often, if persistent caches are enabled) for all the
+# extractor instances.
+FLAVORS = cache.Cache("flavors")
+IMAGES = cache.Cache("images")
+# Servers that did not change, only used if servers_ttl is set
+SERVERS = cache.Cache("servers")
+# Server attributes needed to build the records
+SERVER_ATTRIBUTES = (
+    "id",
+    "name",
+    "user_id",
+    "tenant_id",
+    "status",
+    "created",
+    "updated",
+    "image",
+    "flavor",
+    "addresses",
+    "OS-SRV-USG:launched_at",
+    "OS-SRV-USG:terminated_at",
+)
+# Maximum compute API microversion supported by both the client and the server
+MICROVERSIONS = cache.Cache()
+
+# Servers for all the projects, if nova_all_tenants is set
+ALL_SERVERS = cache.Cache()
+_ALL_SERVERS_LOCK = threading.Lock()
+
+# Usages for all the projects, if nova_all_tenants_usages is set
+ALL_USAGES = cache.Cache()
+_ALL_USAGES_LOCK = threading.Lock()
+
+# Images and servers not listed are requested in batches, using a pool of
+# threads shared by all the extractors (see _get_executor)
+IMAGES_BATCH_SIZE = 50
+SERVERS_BATCH_SIZE = 200
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+# Compute API microversion that includes the extra specs in the flavors
+FLAVOR_EXTRA_SPECS_VERSION = "2.61"
+# Compute API microversion that embeds the flavor information in the servers
+SERVER_FLAVOR_VERSION = "2.47"
+# Compute API microversion that allows to paginate usages
+USAGE_PAGINATION_VERSION = "2.40"
+
+
+def _get_executor():
+    """Get the pool of threads used to request servers and images.
+
+    The pool is shared by all the extractors, so that the number of
+    concurrent requests does not grow with the number of extract workers.
+    """
+    global _EXECUTOR
+
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = futures.ThreadPoolExecutor(max_workers=CONF.nova_api_workers)
+        return _EXECUTOR
+
 
 class NovaExtractor(base.BaseOpenStackExtractor):
     """An OpenStack Compute (Nova) record extractor for cASO."""
@@ -93,12 +199,24 @@ class NovaExtractor(base.BaseOpenStackExtractor):
         self.glance = self._get_glance_client()
         self.neutron = self._get_neutron_client()
 
-        self.flavors = self._get_flavors()
-        self.images = self._get_images()
+        self.embedded_flavors = False
+        if CONF.nova_embedded_flavors:
+            version = self._get_microversion(SERVER_FLAVOR_VERSION)
+            if version < api_versions.APIVersion(SERVER_FLAVOR_VERSION):
+                LOG.warning(
+                    "Compute API does not support embedding the flavor in "
+                    "the servers, flavors will be requested to the API."
+                )
+            else:
+                self.nova = self._get_nova_client(version)
+                self.embedded_flavors = True
+
+        if not self.embedded_flavors:
+            FLAVORS.populate(self._get_flavors)
 
     def _build_acc_records(self, server, server_record, extract_from, extract_to):
         records = {}
-        flavor = self.flavors.get(server.flavor["id"])
+        flavor = self._get_server_flavor(server)
         if not flavor:
             return records
 
@@ -194,13 +312,10 @@ class NovaExtractor(base.BaseOpenStackExtractor):
 
         image_id = None
         if server.image:
-            image = self.images.get(server.image["id"])
-            image_id = server.image["id"]
-            if image:
-                if image.get("vmcatcher_event_ad_mpuri", None) is not None:
-                    image_id = image.get("vmcatcher_event_ad_mpuri", None)
+            # Use the marketplace URI if the image has it
+            image_id = self._get_image(server.image["id"]) or server.image["id"]
 
-        flavor = self.flavors.get(server.flavor["id"])
+        flavor = self._get_server_flavor(server)
         if flavor:
             bench_name = flavor["extra"].get(CONF.benchmark.name_key)
             bench_value = flavor["extra"].get(CONF.benchmark.value_key)
@@ -255,6 +370,12 @@ class NovaExtractor(base.BaseOpenStackExtractor):
         server_start = server_start.replace(tzinfo=None)
         return server_start
 
+    @staticmethod
+    def _get_server_updated(server):
+        server_updated = dateutil.parser.parse(server.updated)
+        server_updated = server_updated.replace(tzinfo=None)
+        return server_updated
+
     @staticmethod
     def _get_server_end(server):
         server_end = server.__getattr__("OS-SRV-USG:terminated_at")
@@ -273,45 +394,283 @@ class NovaExtractor(base.BaseOpenStackExtractor):
             server_end = server_end.replace(tzinfo=None)
         return server_end
 
-    def _get_servers(self, extract_from):
+    @staticmethod
+    def _list_servers(nova, search_opts):
         servers = []
         limit = 200
         marker = None
         # Use a marker and iter over results until we do not have more to get
         while True:
-            aux = self.nova.servers.list(
-                search_opts={"changes-since": extract_from}, limit=limit, marker=marker
-            )
+            aux = nova.servers.list(search_opts=search_opts, limit=limit, marker=marker)
             servers.extend(aux)
 
             if len(aux) < limit:
                 break
             marker = aux[-1].id
+        return servers
+
+    def _list_all_tenants_servers(self, extract_from):
+        """List the servers changed since a date for all the projects."""
+        LOG.debug(f"Listing servers for all projects changed since {extract_from}")
+        nova = self._get_nova_client(self.nova.api_version, system_scope="all")
+        search_opts = {"changes-since": extract_from, "all_tenants": True}
+        servers = {}
+        for server in self._list_servers(nova, search_opts):
+            servers.setdefault(server.tenant_id, []).append(server)
+        return servers
+
+    def _get_all_tenants_servers(self, extract_from):
+        """Get the servers for the project from the listing for all projects.
+
+        The listing is done once and shared by all the projects. As each project
+        may be extracted from a different date, it is repeated only if this
+        project needs an older date than the one used.
+        """
+        with _ALL_SERVERS_LOCK:
+            since, servers = ALL_SERVERS.get("servers") or (None, None)
+            if since is None or since > extract_from:
+                since = extract_from
+                servers = self._list_all_tenants_servers(since)
+                ALL_SERVERS.update({"servers": (since, servers)})
+
+        return [
+            server
+            for server in servers.get(self.project_id, [])
+            if self._get_server_updated(server) >= extract_from
+        ]
+
+    def _get_servers(self, extract_from):
+        if CONF.nova_all_tenants:
+            servers = self._get_all_tenants_servers(extract_from)
+        else:
+            servers = self._list_servers(self.nova, {"changes-since": extract_from})
 
         servers = sorted(servers, key=operator.attrgetter("created"))
         return servers
 
-    def _get_images(self):
-        images = {image.id: image for image in self.glance.images.list()}
+    @staticmethod
+    def _get_image_uri(image):
+        """Get the identifier to report for an image."""
+        mpuri = image.get("vmcatcher_event_ad_mpuri", None)
+        if mpuri is not None:
+            return mpuri
+        return image.id
+
+    def _list_images(self, image_ids):
+        """Get the identifiers to report for a batch of images."""
+        images = {image_id: None for image_id in image_ids}
+        try:
+            filters = {"id": "in:" + ",".join(image_ids)}
+            for image in self.glance.images.list(filters=filters):
+                images[image.id] = self._get_image_uri(image)
+        except glanceclient.exc.HTTPException as e:
+            LOG.debug(f"Cannot list images by ID, getting them one by one: {e}")
+            for image_id in image_ids:
+                images[image_id] = self._load_image(image_id)
         return images
 
+    def _resolve_images(self, image_ids):
+        """Get the images that are not cached yet, in batches.
+
+        Images that cannot be found are also cached, so that they are not
+        requested again.
+        """
+        image_ids = sorted(IMAGES.missing(image_ids))
+        if not image_ids:
+            return
+        batches = []
+        for start in range(0, len(image_ids), IMAGES_BATCH_SIZE):
+            stop = start + IMAGES_BATCH_SIZE
+            batches.append(image_ids[start:stop])
+        for images in _get_executor().map(self._list_images, batches):
+            IMAGES.update(images)
+
+    def _discover_microversion(self, region_name):
+        """Get the maximum microversion supported by the client and server."""
+        try:
+            return api_versions.discover_version(
+                self.nova, api_versions.APIVersion("2.latest")
+            )
+        except novaclient.exceptions.UnsupportedVersion as e:
+            LOG.warning(f"Cannot negotiate compute API microversion: {e}")
+            return api_versions.APIVersion("2.0")
+
+    def _get_microversion(self, version):
+        """Get the given microversion, or the highest available below it."""
+        max_version = MICROVERSIONS.get(CONF.region_name, self._discover_microversion)
+        return min(api_versions.APIVersion(version), max_version)
+
+    def _get_flavors_client(self):
+        """Get a nova client that gets the flavor extra specs, if possible."""
+        version = self._get_microversion(FLAVOR_EXTRA_SPECS_VERSION)
+        if version < api_versions.APIVersion(FLAVOR_EXTRA_SPECS_VERSION):
+            LOG.debug(
+                "Compute API does not support getting the flavor extra specs "
+                "when listing flavors, they will be requested per flavor."
+            )
+        return self._get_nova_client(version)
+
+    @staticmethod
+    def _flavor_to_dict(flavor):
+        ret = flavor.to_dict()
+        # Newer microversions include the extra specs, otherwise we need to
+        # request them for each flavor.
+        extra = ret.pop("extra_specs", None)
+        ret["extra"] = extra if extra is not None else flavor.get_keys()
+        return ret
+
     def _get_flavors(self):
+        nova = self._get_flavors_client()
         flavors = {}
-        for flavor in self.nova.flavors.list():
-            flavors[flavor.id] = flavor.to_dict()
-            flavors[flavor.id]["extra"] = flavor.get_keys()
+        limit = 200
+        marker = None
+        # Use a marker and iter over results until we do not have more to get
+        while True:
+            aux = nova.flavors.list(limit=limit, marker=marker)
+            for flavor in aux:
+                flavors[flavor.id] = self._flavor_to_dict(flavor)
+
+            if len(aux) < limit:
+                break
+            marker = aux[-1].id
         return flavors
 
-    def _get_usages(self, start, end):
-        aux = self.nova.usage.get(self.project_id, start, end)
-        usages = getattr(aux, "server_usages", [])
+    def _load_flavor(self, flavor_id):
+        """Get a flavor that was not listed (e.g. a private one) from the API."""
+        nova = self._get_flavors_client()
+        try:
+            flavor = nova.flavors.get(flavor_id)
+        except novaclient.exceptions.NotFound:
+            return None
+        return self._flavor_to_dict(flavor)
+
+    def _get_flavor(self, flavor_id):
+        return FLAVORS.get(flavor_id, self._load_flavor)
+
+    def _get_server_flavor(self, server):
+        """Get the flavor information for a server."""
+        if not self.embedded_flavors:
+            return self._get_flavor(server.flavor["id"])
+
+        flavor = server.flavor
+        return {
+            "name": flavor.get("original_name"),
+            "vcpus": flavor["vcpus"],
+            "ram": flavor["ram"],
+            "disk": flavor["disk"],
+            "OS-FLV-EXT-DATA:ephemeral": flavor["ephemeral"],
+            # Extra specs are not included if the policy does not allow it
+            "extra": flavor.get("extra_specs", {}),
+        }
+
+    def _load_image(self, image_id):
+        """Get an image that was not requested before from the API."""
+        try:
+            image = self.glance.images.get(image_id)
+        except glanceclient.exc.HTTPNotFound:
+            return None
+        return self._get_image_uri(image)
+
+    def _get_image(self, image_id):
+        return IMAGES.get(image_id, self._load_image)
+
+    def _list_all_tenants_usages(self, start, end):
+        """Get the usages for all the projects, indexed by project and server."""
+        LOG.debug(f"Getting usages for all projects ({start} to {end})")
+        version = self._get_microversion(USAGE_PAGINATION_VERSION)
+        nova = self._get_nova_client(version, system_scope="all")
+
+        usages = {}
+        if version < api_versions.APIVersion(USAGE_PAGINATION_VERSION):
+            pages = [nova.usage.list(start, end, detailed=True)]
+        else:
+            pages = self._list_usage_pages(nova.usage.list, start, end, detailed=True)
+        for page in pages:
+            for tenant_usage in page:
+                tenant_usages = usages.setdefault(tenant_usage.tenant_id, {})
+                for usage in getattr(tenant_usage, "server_usages", []):
+                    tenant_usages[usage["instance_id"]] = usage
         return usages
 
+    @staticmethod
+    def _list_usage_pages(method, *args, **kwargs):
+        """Iterate over the pages of a paginated usage request."""
+        limit = 200
+        marker = None
+        # Use a marker and iter over results until we do not have more to get
+        while True:
+            page = method(*args, marker=marker, limit=limit, **kwargs)
+            if not isinstance(page, list):
+                page = [page]
+            yield page
+
+            server_usages = []
+            for tenant_usage in page:
+                server_usages.extend(getattr(tenant_usage, "server_usages", []))
+            if len(server_usages) < limit:
+                break
+            marker = server_usages[-1]["instance_id"]
+
+    def _get_all_tenants_usages(self, start, end):
+        """Get the usages for the project from the usages for all projects.
+
+        The usages are requested once and shared by all the projects. As each
+        project may be extracted from a different date, they are requested
+        again only if this project needs an older start date.
+        """
+        with _ALL_USAGES_LOCK:
+            since, until, usages = ALL_USAGES.get("usages") or (None, None, None)
+            if since is None or since > start or until != end:
+                since, until = start, end
+                usages = self._list_all_tenants_usages(since, until)
+                ALL_USAGES.update({"usages": (since, until, usages)})
+
+        # Drop the servers that ended before the start of this period
+        return [
+            usage
+            for usage in usages.get(self.project_id, {}).values()
+            if not self._usage_ended_before(usage, start)
+        ]
+
+    @staticmethod
+    def _usage_ended_before(usage, date):
+        if usage.get("ended_at") is None:
+            return False
+        return dateutil.parser.parse(usage["ended_at"]) < date
+
+    def _iter_usages(self, start, end):
+        """Iterate over the usages for the project, one page at a time.
+
+        If the compute API does not support paginating usages, all of them are
+        requested at once.
+        """
+        version = self._get_microversion(USAGE_PAGINATION_VERSION)
+        if version < api_versions.APIVersion(USAGE_PAGINATION_VERSION):
+            aux = self.nova.usage.get(self.project_id, start, end)
+            yield from getattr(aux, "server_usages", [])
+            return
+
+        nova = self._get_nova_client(version)
+        pages = self._list_usage_pages(nova.usage.get, self.project_id, start, end)
+        for page in pages:
+            for tenant_usage in page:
+                yield from getattr(tenant_usage, "server_usages", [])
+
+    def _get_usages(self, start, end):
+        # Windows are not shared by the projects, so the usages of the whole
+        # site would be listed again for each window of each project.
+        if CONF.nova_all_tenants_usages and CONF.backfill_window == "none":
+            return self._get_all_tenants_usages(start, end)
+        return self._iter_usages(start, end)
+
     def _process_servers_for_period(self, servers, extract_from, extract_to):
         for server in servers:
             server_start = self._get_server_start(server)
             server_end = self._get_server_end(server)
 
+            # The server has changed, so the cached one is not valid anymore
+            self._cache_server(server)
+
             # Some servers may be deleted before 'extract_from' but updated
             # afterwards
             if server_start > extract_to or (server_end and server_end < extract_from):
@@ -348,25 +707,122 @@ class NovaExtractor(base.BaseOpenStackExtractor):
                 cput = wall * self.records[server.id].cpu_count
                 self.records[server.id].cpu_duration = cput
 
+    def _load_server(self, server_id):
+        """Get a server from the API, or None if it cannot be found."""
+        try:
+            return self.nova.servers.get(server_id)
+        except novaclient.exceptions.ClientException as e:
+            LOG.warning(
+                "Cannot get server '{}' from the Nova API, probably "
+                "because it is an error in the DB. Please refer to "
+                "the following page for more details: "
+                "https://caso.readthedocs.io/en/stable/"
+                "troubleshooting.html#cannot-find-vm-in-api".format(server_id)
+            )
+            if CONF.debug:
+                LOG.exception(e)
+            return None
+
+    @staticmethod
+    def _usage_fingerprint(usage):
+        """Get the usage values that change if the server changes."""
+        if usage is None:
+            return None
+        return [usage.get("state"), usage.get("flavor"), usage.get("ended_at")]
+
+    def _cache_server(self, server, usage=None):
+        """Store a server in the persistent cache, if enabled.
+
+        :param server: the server to store.
+        :param usage: the usage of the server when it was requested, used to
+                      detect if the server changed afterwards.
+        """
+        if not SERVERS.ttl:
+            return
+        info = server.to_dict()
+        SERVERS.update(
+            {
+                server.id: {
+                    "server": {key: info.get(key) for key in SERVER_ATTRIBUTES},
+                    "usage": self._usage_fingerprint(usage),
+                }
+            }
+        )
+
+    def _get_cached_server(self, server_id, usage):
+        """Get a server from the cache, if it did not change according to usage."""
+        if not SERVERS.ttl or SERVERS.missing([server_id]):
+            return None
+        cached = SERVERS.get(server_id)
+        if not cached or cached["usage"] != self._usage_fingerprint(usage):
+            return None
+        return nova_servers.Server(self.nova.servers, cached["server"], loaded=True)
+
+    def _load_servers(self, usages):
+        """Get the servers for several usages, concurrently.
+
+        Servers that did not change since they were cached are not requested.
+
+        :param usages: dictionary of usages, indexed by server ID.
+        :returns: a dictionary with the servers that could be found.
+        """
+        servers = {}
+        for server_id, usage in usages.items():
+            server = self._get_cached_server(server_id, usage)
+            if server is not None:
+                servers[server_id] = server
+
+        server_ids = sorted(set(usages) - set(servers))
+        if server_ids:
+            loaded = _get_executor().map(self._load_server, server_ids)
+            for server_id, server in zip(server_ids, loaded):
+                if server is None:
+                    continue
+                servers[server_id] = server
+                self._cache_server(server, usages[server_id])
+
+        self._resolve_images(
+            server.image["id"] for server in servers.values() if server.image
+        )
+        return servers
+
     def _process_usages_for_period(self, usages, extract_from, extract_to):
+        usages = iter(usages)
+        while True:
+            batch = list(itertools.islice(usages, SERVERS_BATCH_SIZE))
+            if not batch:
+                break
+
+            # Get at once all the servers that we do not have yet
+            servers = self._load_servers(
+                {
+                    usage["instance_id"]: usage
+                    for usage in batch
+                    if usage["instance_id"] not in self.records
+                }
+            )
+            records, acc_records = self._process_usages_batch(
+                batch, servers, extract_from, extract_to
+            )
+            yield from records.values()
+            yield from acc_records.values()
+
+    def _process_usages_batch(self, usages, servers, extract_from, extract_to):
+        """Build the records for a batch of usages.
+
+        :returns: a tuple with the records and the accelerator records for the
+                  servers that were not found in the changes-since listing.
+        """
+        records = {}
+        acc_records = {}
         for usage in usages:
             # 4.1 and 4.2 Get the server if it is not yet there
-            if usage["instance_id"] not in self.records:
-                try:
-                    server = self.nova.servers.get(usage["instance_id"])
-                except novaclient.exceptions.ClientException as e:
-                    LOG.warning(
-                        "Cannot get server '{}' from the Nova API, probably "
-                        "because it is an error in the DB. Please refer to "
-                        "the following page for more details: "
-                        "https://caso.readthedocs.io/en/stable/"
-                        "troubleshooting.html#cannot-find-vm-in-api".format(
-                            usage["instance_id"]
-                        )
-                    )
-                    if CONF.debug:
-                        LOG.exception(e)
-
+            record = self.records.get(usage["instance_id"])
+            if record is None:
+                record = records.get(usage["instance_id"])
+            if record is None:
+                server = servers.get(usage["instance_id"])
+                if server is None:
                     continue
 
                 server_start = self._get_server_start(server)
@@ -374,10 +830,9 @@ class NovaExtractor(base.BaseOpenStackExtractor):
                     continue
 
                 record = self._build_record(server)
-                acc_records = self._build_acc_records(
-                    server, record, extract_from, extract_to
+                acc_records.update(
+                    self._build_acc_records(server, record, extract_from, extract_to)
                 )
-                self.acc_records.update(acc_records)
 
                 server_start = record.start_time
 
@@ -411,16 +866,28 @@ class NovaExtractor(base.BaseOpenStackExtractor):
                 cput = wall * usage["vcpus"]
                 record.cpu_duration = cput
 
-                self.records[server.id] = record
+                records[server.id] = record
 
             # Adjust resources that may not be
-            record = self.records[usage["instance_id"]]
             record.memory = usage["memory_mb"]
             record.cpu_count = usage["vcpus"]
             record.disk = usage["local_gb"]
 
+        return records, acc_records
+
     def extract(self, extract_from, extract_to):
-        """Extract records for a project from given date querying nova.
+        """Extract records for a project from given date.
+
+        :param extract_from: datetime.datetime object indicating the date to
+                             extract records from
+        :param extract_to: datetime.datetime object indicating the date to
+                           extract records to
+        :returns: A list of cloud records, as given by ``iter_records``
+        """
+        return list(self.iter_records(extract_from, extract_to))
+
+    def iter_records(self, extract_from, extract_to):
+        """Iterate over the records for a project for the given period.
 
         This method will get information from nova.
 
@@ -429,7 +896,7 @@ class NovaExtractor(base.BaseOpenStackExtractor):
                              extract records from
         :param extract_to: datetime.datetime object indicating the date to
                            extract records to
-        :returns: A list of records
+        :returns: An iterator over the records
         """
         # Some API calls do not expect a TZ, so we have to remove the timezone
         # from the dates. We assume that all dates coming from upstream are
@@ -471,13 +938,18 @@ class NovaExtractor(base.BaseOpenStackExtractor):
         # 2.- Build the records for the period. Drop servers outside the period
         # (we do this manually as we cannot limit the query to a period, only
         # changes after start date).
+        self._resolve_images(server.image["id"] for server in servers if server.image)
         self._process_servers_for_period(servers, extract_from, extract_to)
 
-        # 3.- Get all the usages for the period
+        # 3.- Get all the usages for the period (usages may be an iterator, so
+        # that we do not need to hold all of them in memory)
         usages = self._get_usages(extract_from, extract_to)
         # 4.- Iter over the results and
         # This one will also generate accelerator records if GPU flavors
         # are found.
-        self._process_usages_for_period(usages, extract_from, extract_to)
+        # Records built from the usages are yielded batch by batch, the ones
+        # built from the servers are complete once all the usages are seen.
+        yield from self._process_usages_for_period(usages, extract_from, extract_to)
 
-        return list(self.records.values()) + list(self.acc_records.values())
+        yield from self.records.values()
+        yield from self.acc_records.values()
@@ -16,43 +16,264 @@
 
 """Module containing the management of Keystone Clients for cASO."""
 
+import collections
+import json
+import os.path
+import threading
+import time
+
+from keystoneauth1 import access
+from keystoneauth1 import discover
 from keystoneauth1 import exceptions
 from keystoneauth1 import loading
 from keystoneclient.v3 import client as ks_client_v3
 from oslo_config import cfg
+from oslo_log import log
+
+from caso import cache
+from caso import utils
 
 CONF = cfg.CONF
 
 CFG_GROUP = "keystone_auth"
 
+cache_opts = [
+    cfg.BoolOpt(
+        "cache_auth_state",
+        default=False,
+        help="Store the Keystone tokens and the API discovery documents in the "
+        "spool directory, so that runs started within the token lifetime do not "
+        "need to authenticate and discover the API endpoints again. The stored "
+        "file is only readable by the user running cASO.",
+    ),
+    cfg.IntOpt(
+        "discovery_cache_ttl",
+        default=86400,
+        min=0,
+        help="Time (in seconds) that the stored API discovery documents are "
+        "considered valid. Only used if cache_auth_state is enabled.",
+    ),
+]
+
 loading.register_auth_conf_options(CONF, CFG_GROUP)
 loading.register_session_conf_options(CONF, CFG_GROUP)
+CONF.register_opts(cache_opts, group=CFG_GROUP)
+
+LOG = log.getLogger(__name__)
 
-opts = []
+opts = list(cache_opts)
 opts += loading.get_auth_common_conf_options()
 opts += loading.get_session_conf_options()
 opts += loading.get_auth_plugin_conf_options("password")
 
 
-def get_session(conf, project, system_scope=None):
-    """Get an auth session."""
+# Sessions and clients are shared by the whole process, so that tokens are
+# reused (keystoneauth will only re-authenticate when they are about to expire)
+# and all of them share the same HTTP connection pool.
+_SESSIONS = {}
+_CLIENTS = {}
+_LOCK = threading.Lock()
+_KEY_LOCKS = collections.defaultdict(threading.Lock)
+
+# All the projects, indexed by ID, listed once per run
+PROJECTS = cache.Cache()
+
+# Authentication state and discovery documents, optionally persisted between
+# runs (see the cache_auth_state option).
+_AUTH_STATES = {}
+_DISCOVERY_CACHE = {}
+_DISCOVERY_TIMES = {}
+_STATE_LOADED = False
+
+
+def _get_key_lock(key):
+    with _LOCK:
+        return _KEY_LOCKS[key]
+
+
+def _get_http_session():
+    """Get the HTTP session shared by all the Keystone sessions, if any."""
+    with _LOCK:
+        for sess in _SESSIONS.values():
+            return sess.session
+        return None
+
+
+def _get_state_file(conf):
+    return os.path.join(conf.spooldir, "keystone", "state.json")
+
+
+def _load_state(conf):
+    """Load the persisted auth state and discovery documents, once per process."""
+    global _STATE_LOADED
+
+    if not conf[CFG_GROUP].cache_auth_state:
+        return
+
+    with _LOCK:
+        if _STATE_LOADED:
+            return
+        _STATE_LOADED = True
+
+        state_file = _get_state_file(conf)
+        try:
+            with open(state_file, "r") as fd:
+                state = json.load(fd)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            LOG.warning(f"Cannot load Keystone state from '{state_file}': {e}")
+            return
+
+        _AUTH_STATES.update(state.get("auth", {}))
+
+        now = time.time()
+        for url, (timestamp, data) in state.get("discovery", {}).items():
+            if now - timestamp > conf[CFG_GROUP].discovery_cache_ttl:
+                continue
+            disc = _restore_discover(url, data)
+            if disc is None:
+                # Endpoints will be discovered again as usual
+                continue
+            _DISCOVERY_CACHE[url] = disc
+            _DISCOVERY_TIMES[url] = timestamp
+
+
+def _restore_discover(url, data):
+    """Build a keystoneauth Discover object from a stored discovery document.
+
+    keystoneauth does not provide a way to build a Discover object from an
+    existing document, so this relies on its private ``_url`` and ``_data``
+    attributes. If they are not used anymore, None is returned.
+    """
+    disc = discover.Discover.__new__(discover.Discover)
+    disc._url = url
+    disc._data = data
+    try:
+        disc.version_data()
+    except Exception:
+        LOG.debug(f"Cannot restore the discovery document for '{url}'")
+        return None
+    return disc
+
+
+def save_state(conf):
+    """Persist the current auth state and discovery documents, if enabled."""
+    if not conf[CFG_GROUP].cache_auth_state:
+        return
+
+    with _LOCK:
+        states = dict(_AUTH_STATES)
+        for sess in _SESSIONS.values():
+            cache_id = sess.auth.get_cache_id()
+            auth_state = sess.auth.get_auth_state()
+            if cache_id and auth_state:
+                states[cache_id] = auth_state
+
+        now = time.time()
+        discovery = {}
+        for url, disc in _DISCOVERY_CACHE.items():
+            # Private attribute, see _restore_discover
+            data = getattr(disc, "_data", None)
+            if data is None:
+                continue
+            discovery[url] = (_DISCOVERY_TIMES.setdefault(url, now), data)
+
+    # Do not keep tokens that are already expired
+    for cache_id, auth_state in list(states.items()):
+        auth_state = json.loads(auth_state)
+        auth_ref = access.create(
+            body=auth_state["body"], auth_token=auth_state["auth_token"]
+        )
+        if auth_ref.will_expire_soon(stale_duration=0):
+            del states[cache_id]
+
+    state_file = _get_state_file(conf)
+    utils.makedirs(os.path.dirname(state_file))
+    os.chmod(os.path.dirname(state_file), 0o700)
+    utils.write_file(
+        state_file, json.dumps({"auth": states, "discovery": discovery}), mode=0o600
+    )
+
+
+def _load_auth(conf, **kwargs):
+    """Load an auth plugin, restoring its persisted state if there is any."""
+    auth_plugin = loading.load_auth_from_conf_options(conf, CFG_GROUP, **kwargs)
+    auth_state = _AUTH_STATES.get(auth_plugin.get_cache_id())
+    if auth_state:
+        # Expired tokens will be renewed by keystoneauth when used
+        auth_plugin.set_auth_state(auth_state)
+    return auth_plugin
+
+
+def _load_session(conf, project, system_scope=None):
+    """Load a new auth session, checking that we can get a token."""
+    _load_state(conf)
+
+    session_kwargs = {
+        "session": _get_http_session(),
+        "discovery_cache": _DISCOVERY_CACHE,
+    }
+
     # First try using project_id
-    auth_plugin = loading.load_auth_from_conf_options(
-        conf, CFG_GROUP, project_id=project, system_scope=system_scope
+    auth_plugin = _load_auth(conf, project_id=project, system_scope=system_scope)
+    sess = loading.load_session_from_conf_options(
+        conf, CFG_GROUP, auth=auth_plugin, **session_kwargs
     )
-    sess = loading.load_session_from_conf_options(conf, CFG_GROUP, auth=auth_plugin)
     try:
         sess.get_token()
     except exceptions.Unauthorized:
         # Failure, now try project_name
-        auth_plugin = loading.load_auth_from_conf_options(
-            conf, CFG_GROUP, project_name=project, project_id=None
+        auth_plugin = _load_auth(conf, project_name=project, project_id=None)
+        sess = loading.load_session_from_conf_options(
+            conf, CFG_GROUP, auth=auth_plugin, **session_kwargs
         )
-        sess = loading.load_session_from_conf_options(conf, CFG_GROUP, auth=auth_plugin)
     return sess
 
 
+def get_session(conf, project, system_scope=None):
+    """Get an auth session, shared with other callers in this process."""
+    key = (project, system_scope)
+    with _get_key_lock(key):
+        if key not in _SESSIONS:
+            sess = _load_session(conf, project, system_scope)
+            with _LOCK:
+                _SESSIONS[key] = sess
+    return _SESSIONS[key]
+
+
 def get_client(conf, project=None, system_scope=None):
-    """Return a client for Keystone."""
-    sess = get_session(conf, project, system_scope)
-    return ks_client_v3.Client(session=sess, interface="public")
+    """Return a client for Keystone, shared with other callers in this process."""
+    key = (project, system_scope)
+    with _get_key_lock(("client",) + key):
+        if key not in _CLIENTS:
+            sess = get_session(conf, project, system_scope)
+            _CLIENTS[key] = ks_client_v3.Client(session=sess, interface="public")
+    return _CLIENTS[key]
+
+
+def _list_projects(client):
+    projects = {project.id: project.to_dict() for project in client.projects.list()}
+    LOG.debug(f"Got {len(projects)} projects from Keystone")
+    return projects
+
+
+def get_projects(client):
+    """Get all the projects, listing them only once per run.
+
+    :param client: Keystone client allowed to list all the projects.
+    :returns: a dictionary with the projects (as dictionaries) by ID.
+    """
+    PROJECTS.populate(lambda: _list_projects(client))
+    return PROJECTS.items()
+
+
+def get_project(client, project_id):
+    """Get a project from the projects listed once per run.
+
+    :param client: Keystone client allowed to list all the projects.
+    :param project_id: ID of the project.
+    :returns: the project as a dictionary, or None if it was not listed.
+    """
+    PROJECTS.populate(lambda: _list_projects(client))
+    return PROJECTS.get(project_id)
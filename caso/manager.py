@@ -24,6 +24,7 @@ from oslo_config import cfg
 from oslo_log import log
 
 import caso.extract.manager
+from caso import keystone_client
 from caso import loading
 import caso.messenger
 from caso import utils
@@ -39,6 +40,14 @@ opts = [
         ),
     ),
     cfg.StrOpt("spooldir", default="/var/spool/caso", help="Spool directory."),
+    cfg.IntOpt(
+        "push_batch_size",
+        default=1000,
+        min=1,
+        help="Maximum number of records that are pushed to the messengers at "
+        "once. Records are pushed as they are extracted, so that all of them do "
+        "not need to be held in memory.",
+    ),
 ]
 
 override_lock = cfg.StrOpt(
@@ -82,8 +91,10 @@ class Manager(object):
 
     def _load_managers(self):
         # Load the managers here to have the config options loaded and
-        # available
-        self.extractor_manager = caso.extract.manager.Manager()
+        # available. They are reused if the manager runs several times.
+        if self.extractor_manager is not None:
+            return
+        self.extractor_manager = caso.extract.manager.Manager(lock_path=self.lock_path)
         self.messenger = caso.messenger.Manager()
 
     def projects(self):
@@ -106,18 +117,59 @@ class Manager(object):
         """Run the manager.
 
         This method runs the main cASo functionality, namely:
-            - Gets the global lock
+            - Gets the global lock (or the lock of its shard), unless locks are
+              taken per project
             - Gets all records from the configured extractors
-            - Pushes all the records to the messengers
+            - Pushes the records to the messengers, in batches, as they are
+              extracted
+            - Stores the last run of each extractor once its records are pushed,
+              unless pushing some records failed
         """
         self._load_managers()
 
-        @lockutils.synchronized(
-            "caso_should_not_run_in_parallel", lock_path=self.lock_path, external=True
+        def push(batch, checkpoints, pushed):
+            # Once a push fails no last run is stored, so that the records
+            # that were not pushed are extracted again on the next run
+            if batch and not CONF.dry_run:
+                if not self.messenger.push_to_all(batch) and pushed:
+                    LOG.warning(
+                        "Cannot push records, the last runs will not be updated"
+                    )
+                    pushed = False
+            for checkpoint in checkpoints:
+                self.extractor_manager.write_checkpoint(checkpoint, pushed=pushed)
+            return pushed
+
+        def extract_and_push():
+            batch = []
+            checkpoints = []
+            pushed = True
+            try:
+                for record in self.extractor_manager.iter_records():
+                    if isinstance(record, caso.extract.manager.Checkpoint):
+                        checkpoints.append(record)
+                        continue
+                    batch.append(record)
+                    if len(batch) >= CONF.push_batch_size:
+                        pushed = push(batch, checkpoints, pushed)
+                        batch = []
+                        checkpoints = []
+                push(batch, checkpoints, pushed)
+            finally:
+                # Projects are locked until their records are pushed
+                self.extractor_manager.release_locks()
+            keystone_client.save_state(CONF)
+
+        if CONF.lock_granularity == "project":
+            # The extractor manager locks each project while extracting it
+            return extract_and_push()
+
+        lock_name = "caso_should_not_run_in_parallel"
+        if CONF.shard_count > 1:
+            # Instances extracting different shards can run at the same time
+            lock_name += f"_shard_{CONF.shard_index}_of_{CONF.shard_count}"
+
+        synchronized = lockutils.synchronized(
+            lock_name, lock_path=self.lock_path, external=True
         )
-        def synchronized():
-            records = self.extractor_manager.get_records()
-            if not CONF.dry_run:
-                self.messenger.push_to_all(records)
-
-        return synchronized()
+        return synchronized(extract_and_push)()
@@ -51,10 +51,15 @@ class Manager(object):
             raise e
 
     def push_to_all(self, records):
-        """Push records to all the configured messengers."""
+        """Push records to all the configured messengers.
+
+        :returns: whether the records were pushed to all the messengers.
+        """
         try:
             self.mgr.map_method("push", records)
         except Exception as e:
             # Capture exception so that we can continue working
             LOG.error("Something happeneded when pushing records.")
             LOG.exception(e)
+            return False
+        return True
@@ -18,13 +18,17 @@
 
 import itertools
 
+import caso._cmd.daemon
+import caso.cache
 import caso.extract.base
 import caso.extract.manager
+import caso.extract.openstack.base
 import caso.extract.openstack.nova
 import caso.keystone_client
 import caso.manager
 import caso.messenger.logstash
 import caso.messenger.ssm
+import caso.state
 
 
 def list_opts():
@@ -37,10 +41,16 @@ def list_opts():
                 caso.manager.cli_opts,
                 caso.extract.base.opts,
                 caso.extract.manager.cli_opts,
+                caso.extract.manager.opts,
+                caso.extract.openstack.base.opts,
+                caso.extract.openstack.nova.opts,
+                caso.state.opts,
             ),
         ),
         ("accelerator", caso.extract.openstack.nova.accelerator_opts),
         ("benchmark", caso.extract.openstack.nova.benchmark_opts),
+        ("cache", caso.cache.opts),
+        ("daemon", caso._cmd.daemon.opts),
         ("keystone_auth", caso.keystone_client.opts),
         ("logstash", caso.messenger.logstash.opts),
         ("ssm", caso.messenger.ssm.opts),
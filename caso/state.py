@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2014 Spanish National Research Council (CSIC)
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Module containing the store for the state of the cASO extractors."""
+
+import glob
+import sqlite3
+import threading
+
+import dateutil.parser
+from oslo_config import cfg
+from oslo_log import log
+
+opts = [
+    cfg.StrOpt(
+        "state_backend",
+        default="file",
+        choices=[
+            (
+                "file",
+                "Store the last run of each project and extractor in its own "
+                "lastrun file in the spool directory.",
+            ),
+            (
+                "sqlite",
+                "Store all the last runs in a single SQLite database in the spool "
+                "directory, importing the existing lastrun files.",
+            ),
+        ],
+        help="Where the state of the extractors (i.e. the last run dates) is "
+        "stored.",
+    ),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(opts)
+
+LOG = log.getLogger(__name__)
+
+# Version of the database once the lastrun files are imported
+IMPORTED_VERSION = 1
+
+
+class SQLiteStore(object):
+    """Store the last run dates in a single SQLite database.
+
+    All the dates are read at once when the store is opened, and each update
+    is committed in its own transaction, so that a crash never leaves a
+    partially written date behind. The dates of a project can be read again
+    with ``refresh``, if other processes may have updated them.
+    """
+
+    def __init__(self, path):
+        """Open (or create) the database.
+
+        :param path: path to the database file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lastrun ("
+                "project TEXT NOT NULL, "
+                "extractor TEXT NOT NULL, "
+                "date TEXT NOT NULL, "
+                "PRIMARY KEY (project, extractor))"
+            )
+        rows = self._conn.execute("SELECT project, extractor, date FROM lastrun")
+        self._lastrun = {
+            (project, extractor): date for project, extractor, date in rows
+        }
+
+    def get(self, project, extractor=None):
+        """Get the last run date of a project, as a string.
+
+        :param extractor: if set, get the date for this extractor only.
+        :returns: the date, or None if there is no date stored.
+        """
+        return self._lastrun.get((project, extractor or ""))
+
+    def set(self, project, date, extractor=None):
+        """Store the last run date of a project.
+
+        :param date: date to store.
+        :param extractor: if set, store the date for this extractor only.
+        """
+        key = (project, extractor or "")
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO lastrun VALUES (?, ?, ?)",
+                    key + (str(date),),
+                )
+            self._lastrun[key] = str(date)
+
+    def refresh(self, project):
+        """Read again the last run dates of a project from the database.
+
+        :param project: project whose dates are read.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT extractor, date FROM lastrun WHERE project = ?", (project,)
+            ).fetchall()
+            for extractor, date in rows:
+                self._lastrun[(project, extractor)] = date
+
+    def import_files(self, base, extractors):
+        """Import the dates from existing lastrun files, only once.
+
+        Dates already in the database are not overwritten, and files that
+        cannot be parsed are ignored. The files are not removed.
+
+        :param base: base path of the lastrun files.
+        :param extractors: names of the extractors, used to tell the files of
+                           a project and extractor from the ones of a project.
+        """
+        with self._lock:
+            (version,) = self._conn.execute("PRAGMA user_version").fetchone()
+            if version >= IMPORTED_VERSION:
+                return
+
+            rows = []
+            prefix = f"{base}."
+            for path in sorted(glob.glob(f"{glob.escape(base)}.*")):
+                name = path.replace(prefix, "", 1)
+                project, _, extractor = name.rpartition(".")
+                if not project or extractor not in extractors:
+                    project, extractor = name, ""
+                try:
+                    with open(path, "r") as fd:
+                        date = fd.read().strip()
+                    dateutil.parser.parse(date)
+                except (OSError, ValueError, OverflowError):
+                    LOG.warning(f"Cannot read date from lastrun file '{path}'")
+                    continue
+                rows.append((project, extractor, date))
+
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO lastrun VALUES (?, ?, ?)", rows
+                )
+                self._conn.execute(f"PRAGMA user_version = {IMPORTED_VERSION}")
+            for project, extractor, date in rows:
+                self._lastrun.setdefault((project, extractor), date)
+            LOG.info(f"Imported {len(rows)} lastrun files into '{self.path}'")
@@ -15,13 +15,21 @@
 """Tests for `caso.extract.manager` module."""
 
 import datetime
+import itertools
+import os
+import sys
+import threading
+import time
 import uuid
 
 import dateutil.parser
+import fixtures
 from dateutil import tz
 import mock
 import six
 
+from caso import cache
+from caso import exception
 from caso.extract import manager
 from caso.tests import base
 
@@ -37,7 +45,7 @@ class TestCasoManager(base.TestCase):
         patched = self.p_extractors.start()
         self.records = [{uuid.uuid4().hex: None}]
         self.m_extractor = mock.MagicMock()
-        self.m_extractor.return_value.extract.return_value = self.records
+        self.m_extractor.return_value.iter_records.return_value = self.records
         patched.return_value = {"mock": self.m_extractor}
 
         self.p_keystone = mock.patch(
@@ -60,7 +68,7 @@ class TestCasoManager(base.TestCase):
         self.flags(projects=[])
 
         ret = self.manager.get_records()
-        self.assertFalse(self.m_extractor.extract.called)
+        self.assertFalse(self.m_extractor.iter_records.called)
         self.assertEqual(ret, [])
 
     def test_extract(self):
@@ -77,7 +85,7 @@ class TestCasoManager(base.TestCase):
             "bazonk",
             mock.ANY,
         )
-        self.m_extractor.return_value.extract.assert_called_once_with(
+        self.m_extractor.return_value.iter_records.assert_called_once_with(
             dateutil.parser.parse(extract_from).replace(tzinfo=tz.tzutc()),
             dateutil.parser.parse(extract_to).replace(tzinfo=tz.tzutc()),
         )
@@ -107,12 +115,12 @@ class TestCasoManager(base.TestCase):
 
             ret = self.manager.get_records()
 
-            m.assert_called_once_with("bazonk")
+            m.assert_called_once_with("bazonk", "mock")
             self.m_extractor.assert_called_once_with(
                 "bazonk",
                 mock.ANY,
             )
-            self.m_extractor.return_value.extract.assert_called_once_with(
+            self.m_extractor.return_value.iter_records.assert_called_once_with(
                 dateutil.parser.parse(lastrun).replace(tzinfo=tz.tzutc()),
                 dateutil.parser.parse(extract_to).replace(tzinfo=tz.tzutc()),
             )
@@ -151,16 +159,409 @@ class TestCasoManager(base.TestCase):
 
         with mock.patch.object(self.manager, "write_lastrun") as m:
             self.manager.get_records()
-            m.assert_called_once_with("bazonk")
+            m.assert_called_once_with("bazonk", mock.ANY, extractor="mock")
 
     def test_write_lastrun(self):
-        """Test that we actually write lastrun files."""
+        """Test that we actually write lastrun files, atomically."""
         self.flags(projects=["bazonk"])
-        if six.PY3:
-            builtins_open = "builtins.open"
-        else:
-            builtins_open = "__builtin__.open"
 
-        with mock.patch(builtins_open, mock.mock_open()) as m:
+        with mock.patch("caso.utils.write_file") as m:
+            self.manager.get_records()
+            m.assert_called_once_with(
+                "/var/spool/caso/lastrun.bazonk.mock", mock.ANY, mode=0o644
+            )
+
+    def test_get_records_with_workers(self):
+        """Test that concurrent extraction keeps the record order."""
+        self.flags(dry_run=True)
+        self.flags(extract_workers=4)
+        self.flags(projects=["foo", "bar", "baz", "bazonk"])
+        self.flags(extract_from="1999-12-19")
+        self.flags(extract_to="2015-12-19")
+
+        def extractor(project, vo):
+            ret = mock.MagicMock()
+            ret.iter_records.return_value = [project]
+            return ret
+
+        self.m_extractor.side_effect = extractor
+
+        with mock.patch.object(self.manager, "write_lastrun") as m:
+            ret = self.manager.get_records()
+            self.assertEqual(4, m.call_count)
+        self.assertEqual(["bar", "baz", "bazonk", "foo"], ret)
+
+    def test_get_records_workers_and_parallel_extractors(self):
+        """Test that extract workers share the records in flight."""
+        self.flags(dry_run=True)
+        self.flags(extract_workers=4)
+        self.flags(parallel_extractors=True)
+        self.flags(max_in_flight_records=100)
+        self.flags(projects=["foo", "bar"])
+        self.flags(extract_from="1999-12-19")
+        self.flags(extract_to="2015-12-19")
+
+        m_other = mock.MagicMock()
+        m_other.return_value.iter_records.side_effect = lambda *args: ["other"]
+        self.m_extractor.return_value.iter_records.side_effect = lambda *args: ["mock"]
+        self.manager.extractors = [("mock", self.m_extractor), ("other", m_other)]
+
+        with mock.patch(
+            "caso.extract.manager._iter_concurrently",
+            wraps=manager._iter_concurrently,
+        ) as m_iter:
+            ret = self.manager.get_records()
+        self.assertEqual(["mock", "other"] * 2, ret)
+        self.assertEqual(
+            [(4, 100), (2, 25), (2, 25)],
+            [call[0][1:] for call in m_iter.call_args_list],
+        )
+
+    def test_get_records_parallel_extractors(self):
+        """Test that extractors run in parallel are isolated from each other."""
+        self.flags(dry_run=True)
+        self.flags(parallel_extractors=True)
+        self.flags(projects=["bazonk"])
+        self.flags(extract_from="1999-12-19")
+        self.flags(extract_to="2015-12-19")
+
+        m_failing = mock.MagicMock()
+        m_failing.return_value.iter_records.side_effect = Exception("bazonk")
+        m_other = mock.MagicMock()
+        m_other.return_value.iter_records.return_value = ["foo"]
+        self.manager.extractors = [
+            ("mock", self.m_extractor),
+            ("failing", m_failing),
+            ("other", m_other),
+        ]
+
+        ret = self.manager.get_records()
+        self.assertEqual(self.records + ["foo"], ret)
+
+    def test_iter_concurrently_bounded(self):
+        """Test that workers block when the consumer falls behind."""
+        produced = []
+
+        def produce(name):
+            for i in range(10):
+                produced.append((name, i))
+                yield (name, i)
+
+        records = manager._iter_concurrently(
+            [produce("foo"), produce("bar")], max_workers=2, max_in_flight=4
+        )
+        self.assertEqual(("foo", 0), next(records))
+        time.sleep(0.3)
+        # Each worker can only be ahead by its share of in flight records
+        self.assertLessEqual(len(produced), 4 + 2 + 1)
+        self.assertEqual(
+            [("foo", i) for i in range(1, 10)] + [("bar", i) for i in range(10)],
+            list(records),
+        )
+
+    def test_iter_concurrently_bounded_many_iterables(self):
+        """Test that the limit holds with many small iterables behind a big one."""
+        lock = threading.Lock()
+        counts = {"in_flight": 0, "peak": 0}
+
+        def produce(size):
+            for i in range(size):
+                with lock:
+                    counts["in_flight"] += 1
+                    counts["peak"] = max(counts["peak"], counts["in_flight"])
+                yield i
+
+        iterables = [produce(200)] + [produce(5) for _ in range(199)]
+        records = manager._iter_concurrently(iterables, max_workers=4, max_in_flight=40)
+        consumed = 0
+        for _ in records:
+            consumed += 1
+            with lock:
+                counts["in_flight"] -= 1
+            if consumed <= 200:
+                # The consumer falls behind while reading the big iterable
+                time.sleep(0.001)
+
+        self.assertEqual(200 + 199 * 5, consumed)
+        # Each worker can be ahead by its share, plus the item it is putting
+        self.assertLessEqual(counts["peak"], 40 + 4 + 1)
+
+    def test_iter_concurrently_failure(self):
+        """Test that errors in the workers are raised in the consumer."""
+
+        def fail():
+            yield "foo"
+            raise ValueError("bazonk")
+
+        records = manager._iter_concurrently(
+            [iter(["bar"]), fail(), iter(["baz"])], max_workers=2, max_in_flight=10
+        )
+        self.assertEqual("bar", next(records))
+        self.assertEqual("foo", next(records))
+        self.assertRaises(ValueError, next, records)
+
+    def test_iter_concurrently_nested_failure(self):
+        """Test that nested workers stop if another nested iterable fails."""
+        threads = threading.active_count()
+
+        def fail():
+            yield "foo"
+            sys.exit(1)
+
+        def nested(iterable):
+            return manager._iter_concurrently(
+                [iterable, itertools.count()], max_workers=2, max_in_flight=2
+            )
+
+        records = manager._iter_concurrently(
+            [nested(fail()), nested(itertools.count())],
+            max_workers=2,
+            max_in_flight=4,
+        )
+        self.assertRaises(SystemExit, list, records)
+
+        for _ in range(50):
+            if threading.active_count() <= threads:
+                break
+            time.sleep(0.1)
+        self.assertEqual(threads, threading.active_count())
+
+    def test_iter_concurrently_consumer_stops(self):
+        """Test that workers stop when the consumer stops."""
+        produced = []
+
+        def produce():
+            for i in range(100):
+                produced.append(i)
+                yield i
+
+        records = manager._iter_concurrently(
+            [produce(), produce()], max_workers=2, max_in_flight=2
+        )
+        self.assertEqual(0, next(records))
+        records.close()
+        self.assertLess(len(produced), 10)
+
+    def test_get_records_backfill_window(self):
+        """Test that the period is extracted in windows, with checkpoints."""
+        self.flags(projects=["bazonk"])
+        self.flags(backfill_window="month")
+        self.flags(extract_from="2015-10-15")
+        self.flags(extract_to="2015-12-19")
+
+        with mock.patch.object(self.manager, "write_lastrun") as m:
+            ret = self.manager.get_records()
+
+        dates = [
+            dateutil.parser.parse(date).replace(tzinfo=tz.tzutc())
+            for date in ("2015-10-15", "2015-11-15", "2015-12-15", "2015-12-19")
+        ]
+        self.assertEqual(
+            [mock.call(start, end) for start, end in zip(dates, dates[1:])],
+            self.m_extractor.return_value.iter_records.call_args_list,
+        )
+        self.assertEqual(
+            [
+                mock.call("bazonk", dates[1], extractor="mock"),
+                mock.call("bazonk", dates[2], extractor="mock"),
+                mock.call("bazonk", dates[3], extractor="mock"),
+            ],
+            m.call_args_list,
+        )
+        self.assertEqual(self.records * 3, ret)
+
+    def test_write_lastrun_only_for_healthy_extractors(self):
+        """Test that failing extractors do not move their last run forward."""
+        self.flags(projects=["bazonk"])
+        self.flags(backfill_window="month")
+        self.flags(extract_from="2015-10-15")
+        self.flags(extract_to="2015-12-19")
+
+        def fail(extract_from, extract_to):
+            if extract_from.month == 11:
+                raise Exception("bazonk")
+            return ["foo"]
+
+        m_failing = mock.MagicMock()
+        m_failing.return_value.iter_records.side_effect = fail
+        self.manager.extractors = [
+            ("mock", self.m_extractor),
+            ("failing", m_failing),
+        ]
+
+        with mock.patch.object(self.manager, "write_lastrun") as m:
+            ret = self.manager.get_records()
+
+        self.assertEqual(self.records * 3 + ["foo"], ret)
+        # The failed window is not extracted again, nor the following ones
+        self.assertEqual(2, m_failing.return_value.iter_records.call_count)
+        self.assertEqual(
+            [
+                mock.call("bazonk", mock.ANY, extractor="mock"),
+                mock.call("bazonk", mock.ANY, extractor="mock"),
+                mock.call("bazonk", mock.ANY, extractor="mock"),
+                mock.call("bazonk", mock.ANY, extractor="failing"),
+            ],
+            m.call_args_list,
+        )
+
+    def test_lastrun_falls_back_to_project(self):
+        """Test that the project last run is used if the extractor has none."""
+        expected = datetime.datetime(2014, 12, 10, 13, 10, 26, 664598)
+        fopen = mock.mock_open(read_data=str(expected))
+        with mock.patch("os.path.exists") as path:
+            with mock.patch("builtins.open", fopen):
+                path.side_effect = lambda p: not p.endswith(".nova")
+                self.assertEqual(expected, self.manager.get_lastrun("foo", "nova"))
+        fopen.assert_called_once_with("/var/spool/caso/lastrun.foo", "r")
+
+    def test_lastrun_sqlite_state(self):
+        """Test that the last runs are kept in the SQLite state store."""
+        spooldir = self.useFixture(fixtures.TempDir()).path
+        self.flags(spooldir=spooldir)
+        self.flags(state_backend="sqlite")
+        with open(os.path.join(spooldir, "lastrun.foo"), "w") as fd:
+            fd.write("2015-12-19 00:00:00+00:00")
+
+        self.manager = manager.Manager()
+        expected = datetime.datetime(2015, 12, 19, tzinfo=tz.tzutc())
+        self.assertEqual(expected, self.manager.get_lastrun("foo", "mock"))
+
+        date = datetime.datetime(2015, 12, 20, tzinfo=tz.tzutc())
+        self.manager.write_lastrun("foo", date, extractor="mock")
+        self.assertEqual(date, manager.Manager().get_lastrun("foo", "mock"))
+        self.assertEqual(expected, manager.Manager().get_lastrun("foo"))
+
+    def test_projects_and_vos_from_index(self):
+        """Test that projects and VOs are taken from a single listing."""
+        self.flags(projects=["foo"])
+        self.flags(vo_property="VO")
+        tagged = mock.MagicMock(id="bar")
+        tagged.to_dict.return_value = {"id": "bar", "tags": ["caso"], "VO": "baz"}
+        other = mock.MagicMock(id="bazonk")
+        other.to_dict.return_value = {"id": "bazonk", "tags": []}
+        self.manager.keystone.projects.list.return_value = [tagged, other]
+        self.addCleanup(cache.reset)
+        cache.reset()
+
+        self.assertEqual({"foo", "bar"}, self.manager.projects)
+        self.assertEqual("baz", self.manager.get_project_vo("bar"))
+        self.manager.keystone.projects.list.assert_called_once_with()
+        self.assertFalse(self.manager.keystone.projects.get.called)
+
+    def test_projects_sharded(self):
+        """Test that each project is assigned to exactly one shard."""
+        projects = [uuid.uuid4().hex for _ in range(20)]
+        self.flags(projects=projects)
+        self.flags(shard_count=3)
+
+        assigned = []
+        for index in range(3):
+            self.flags(shard_index=index)
+            assigned.extend(self.manager.projects)
+        self.assertEqual(sorted(projects), sorted(assigned))
+
+    def test_invalid_shard(self):
+        """Test that the shard index must be lower than the shard count."""
+        self.flags(shard_count=2)
+        self.flags(shard_index=2)
+        self.assertRaises(exception.InvalidShardError, manager.Manager)
+
+    def test_get_records_skips_locked_projects(self):
+        """Test that projects locked by another process are skipped."""
+        lock_path = "/var/lock/caso"
+        self.flags(dry_run=True)
+        self.flags(lock_granularity="project")
+        self.flags(projects=["foo", "bar"])
+        self.manager = manager.Manager(lock_path=lock_path)
+
+        def extractor(project, vo):
+            ret = mock.MagicMock()
+            ret.iter_records.return_value = [project]
+            return ret
+
+        self.m_extractor.side_effect = extractor
+
+        locks = {
+            "caso_project_foo": mock.MagicMock(),
+            "caso_project_bar": mock.MagicMock(),
+        }
+        locks["caso_project_foo"].acquire.return_value = True
+        # Locked by another process
+        locks["caso_project_bar"].acquire.return_value = False
+        with mock.patch("oslo_concurrency.lockutils.external_lock") as m:
+            m.side_effect = lambda name, lock_path: locks[name]
+            ret = self.manager.get_records()
+
+        self.assertEqual(["foo"], ret)
+        locks["caso_project_foo"].acquire.assert_called_once_with(blocking=False)
+        locks["caso_project_foo"].release.assert_called_once_with()
+        self.assertFalse(locks["caso_project_bar"].release.called)
+        m.assert_any_call("caso_project_foo", lock_path=lock_path)
+
+    def test_get_records_project_locks_refresh_state(self):
+        """Test that last runs are read again once a project is locked."""
+        spooldir = self.useFixture(fixtures.TempDir()).path
+        self.flags(spooldir=spooldir)
+        self.flags(state_backend="sqlite")
+        self.flags(lock_granularity="project")
+        self.flags(projects=["foo"])
+        self.manager = manager.Manager(lock_path=spooldir)
+
+        # Another process extracted the project after the store was opened
+        date = datetime.datetime.now(tz.tzutc()) - datetime.timedelta(hours=1)
+        other = manager.state.SQLiteStore(os.path.join(spooldir, "state.db"))
+        other.set("foo", date, extractor="mock")
+
+        with mock.patch("oslo_concurrency.lockutils.external_lock"):
             self.manager.get_records()
-            m.assert_called_once_with("/var/spool/caso/lastrun.bazonk", "w")
+
+        self.m_extractor.return_value.iter_records.assert_called_once_with(
+            date, mock.ANY
+        )
+
+    def test_get_records_extractor_intervals(self):
+        """Test that extractors are skipped until their interval elapses."""
+        self.flags(projects=["bazonk"])
+        self.flags(extractor_intervals={"daily": 86400})
+        m_daily = mock.MagicMock()
+        m_daily.return_value.iter_records.return_value = ["foo"]
+        self.manager.extractors = [
+            ("mock", self.m_extractor),
+            ("daily", m_daily),
+        ]
+        now = datetime.datetime.now(tz.tzutc())
+
+        with mock.patch.object(self.manager, "get_lastrun") as m_lastrun:
+            with mock.patch.object(self.manager, "write_lastrun") as m_write:
+                m_lastrun.return_value = now - datetime.timedelta(hours=1)
+                ret = self.manager.get_records()
+                self.assertEqual(self.records, ret)
+                m_write.assert_called_once_with("bazonk", mock.ANY, extractor="mock")
+
+                m_lastrun.return_value = now - datetime.timedelta(days=2)
+                ret = self.manager.get_records()
+                self.assertEqual(self.records + ["foo"], ret)
+
+                # Started a bit earlier than a day after the last one
+                m_lastrun.return_value = now - datetime.timedelta(days=1, seconds=-5)
+                ret = self.manager.get_records()
+                self.assertEqual(self.records + ["foo"], ret)
+
+    def test_get_records_extractor_intervals_no_drift(self):
+        """Test that the interval does not drift with the extraction time."""
+        self.flags(projects=["bazonk"])
+        self.flags(extract_to="2015-12-19 00:00:00+00:00")
+        self.flags(extractor_intervals={"mock": 86400})
+
+        with mock.patch.object(self.manager, "get_lastrun") as m_lastrun:
+            m_lastrun.return_value = datetime.datetime(2015, 12, 18, tzinfo=tz.tzutc())
+            with mock.patch.object(self.manager, "write_lastrun") as m_write:
+                self.manager.get_records()
+
+        # The last run is the end of the period, not when the run finished
+        m_write.assert_called_once_with(
+            "bazonk",
+            datetime.datetime(2015, 12, 19, tzinfo=tz.tzutc()),
+            extractor="mock",
+        )
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for `caso.extract.openstack.neutron` module."""
+
+import datetime
+
+from dateutil import tz
+import mock
+
+from caso import cache
+from caso.extract.openstack import neutron
+from caso.tests import base
+
+
+class TestNeutronExtractor(base.TestCase):
+    """Test case for the Neutron extractor."""
+
+    def setUp(self):
+        """Run before each test method to initialize test environment."""
+        super(TestNeutronExtractor, self).setUp()
+        self.patchers = {
+            name: mock.patch.object(neutron.NeutronExtractor, name)
+            for name in (
+                "_get_keystone_client",
+                "_get_project_id",
+                "_get_neutron_client",
+            )
+        }
+        self.mocks = {name: p.start() for name, p in self.patchers.items()}
+        self.m_neutron = self.mocks["_get_neutron_client"].return_value
+        cache.reset()
+        self.extractor = neutron.NeutronExtractor("foo", "bar")
+
+    def tearDown(self):
+        """Run after each test, reset state and environment."""
+        for p in self.patchers.values():
+            p.stop()
+        cache.reset()
+        self.reset_flags()
+
+        super(TestNeutronExtractor, self).tearDown()
+
+    def test_records_for_both_ip_versions(self):
+        """Test that IPv4 and IPv6 addresses are reported in separate records."""
+        created_at = "2015-12-18T00:00:00Z"
+        self.m_neutron.list_floatingips.return_value = {
+            "floatingips": [
+                {"floating_ip_address": "192.0.2.1", "created_at": created_at},
+                {"floating_ip_address": "192.0.2.2", "created_at": created_at},
+                {"floating_ip_address": "2001:db8::1", "created_at": created_at},
+            ]
+        }
+        extract_from = datetime.datetime(2015, 12, 17, tzinfo=tz.tzutc())
+        extract_to = datetime.datetime(2015, 12, 19, tzinfo=tz.tzutc())
+
+        with mock.patch.object(self.extractor, "_build_ip_record") as m_build:
+            m_build.side_effect = lambda user_id, count, version: (version, count)
+            records = self.extractor.extract(extract_from, extract_to)
+
+        # The IPv6 record does not replace the IPv4 one of the same user
+        self.assertEqual([(4, 2), (6, 1)], records)
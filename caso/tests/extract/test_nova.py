@@ -14,9 +14,22 @@
 
 """Tests for the OpenStack nova extractor."""
 
+import datetime
+import time
+
+import glanceclient.exc
+import keystoneauth1.exceptions
+import mock
+from novaclient import api_versions
+import novaclient.exceptions
+
+from caso import cache
+from caso.extract.openstack import base as openstack_base
 from caso.extract.openstack import nova
 from caso.tests import base
 
+nova.CONF.import_opt("debug", "caso.config")
+
 
 class TestCasoManager(base.TestCase):
     """Test case for Nova extractor."""
@@ -24,11 +37,378 @@ class TestCasoManager(base.TestCase):
     def setUp(self):
         """Run before each test method to initialize test environment."""
         super(TestCasoManager, self).setUp()
-        self.flags(mapping_file="etc/caso/voms.json.sample")
-        self.extractor = nova.NovaExtractor()
+        self.patchers = {
+            name: mock.patch.object(nova.NovaExtractor, name)
+            for name in (
+                "_get_keystone_client",
+                "_get_project_id",
+                "_get_nova_client",
+                "_get_glance_client",
+                "_get_neutron_client",
+            )
+        }
+        self.patchers["discover_version"] = mock.patch(
+            "novaclient.api_versions.discover_version",
+            return_value=api_versions.APIVersion("2.61"),
+        )
+        self.mocks = {name: p.start() for name, p in self.patchers.items()}
+        self.m_nova = self.mocks["_get_nova_client"].return_value
+        self.m_glance = self.mocks["_get_glance_client"].return_value
+        self.m_keystone = self.mocks["_get_keystone_client"].return_value
+        self.m_flavor = mock.MagicMock(id="flavor-id")
+        self.m_flavor.to_dict.return_value = {"id": "flavor-id"}
+        self.m_flavor.get_keys.return_value = {}
+        self.m_nova.flavors.list.return_value = [self.m_flavor]
+        cache.reset()
+        self.extractor = nova.NovaExtractor("foo", "bar")
 
     def tearDown(self):
         """Run after each test, reset state and environment."""
+        for p in self.patchers.values():
+            p.stop()
+        cache.reset()
         self.reset_flags()
 
         super(TestCasoManager, self).tearDown()
+
+    def test_legacy_extractors(self):
+        """Test that extractors only implementing extract still work."""
+
+        class LegacyExtractor(openstack_base.BaseOpenStackExtractor):
+            def extract(self, extract_from, extract_to):
+                return ["record"]
+
+        with mock.patch.object(LegacyExtractor, "_get_keystone_client"):
+            with mock.patch.object(LegacyExtractor, "_get_project_id"):
+                extractor = LegacyExtractor("foo", "bar")
+        self.assertEqual(["record"], list(extractor.iter_records(None, None)))
+
+        with mock.patch.object(self.extractor, "iter_records") as m_iter:
+            m_iter.return_value = iter(["record"])
+            self.assertEqual(["record"], self.extractor.extract(None, None))
+
+    def test_flavors_are_shared(self):
+        """Test that flavors are only listed once for all the extractors."""
+        nova.NovaExtractor("bar", "baz")
+        self.m_nova.flavors.list.assert_called_once_with(limit=200, marker=None)
+        self.assertEqual(
+            {"id": "flavor-id", "extra": {}}, self.extractor._get_flavor("flavor-id")
+        )
+
+    def test_flavor_miss_falls_back_to_api(self):
+        """Test that missing flavors are requested to the API only once."""
+        self.m_nova.flavors.get.side_effect = novaclient.exceptions.NotFound(404)
+        self.assertIsNone(self.extractor._get_flavor("other"))
+        self.assertIsNone(self.extractor._get_flavor("other"))
+        self.m_nova.flavors.get.assert_called_once_with("other")
+
+    def test_flavors_extra_specs_inline(self):
+        """Test that extra specs are not requested if they are listed."""
+        flavor = mock.MagicMock(id="other")
+        flavor.to_dict.return_value = {"id": "other", "extra_specs": {"foo": "bar"}}
+        self.m_nova.flavors.list.return_value = [flavor]
+        cache.reset()
+
+        nova.NovaExtractor("bar", "baz")
+        self.mocks["_get_nova_client"].assert_called_with(
+            api_versions.APIVersion("2.61")
+        )
+        self.assertEqual(
+            {"id": "other", "extra": {"foo": "bar"}},
+            self.extractor._get_flavor("other"),
+        )
+        self.assertFalse(flavor.get_keys.called)
+
+    def test_flavors_old_microversion(self):
+        """Test that we get extra specs per flavor with old microversions."""
+        self.mocks["discover_version"].return_value = api_versions.APIVersion("2.60")
+        cache.reset()
+
+        nova.NovaExtractor("bar", "baz")
+        self.mocks["_get_nova_client"].assert_called_with(
+            api_versions.APIVersion("2.60")
+        )
+        self.m_flavor.get_keys.assert_called_with()
+
+    def test_embedded_flavors(self):
+        """Test that the flavor is taken from the server if configured."""
+        self.flags(nova_embedded_flavors=True)
+        self.m_nova.flavors.list.reset_mock()
+        cache.reset()
+
+        extractor = nova.NovaExtractor("bar", "baz")
+        self.assertFalse(self.m_nova.flavors.list.called)
+
+        server = mock.MagicMock()
+        server.flavor = {
+            "original_name": "m1.foo",
+            "vcpus": 2,
+            "ram": 1024,
+            "disk": 10,
+            "ephemeral": 5,
+            "swap": 0,
+            "extra_specs": {"foo": "bar"},
+        }
+        self.assertEqual(
+            {
+                "name": "m1.foo",
+                "vcpus": 2,
+                "ram": 1024,
+                "disk": 10,
+                "OS-FLV-EXT-DATA:ephemeral": 5,
+                "extra": {"foo": "bar"},
+            },
+            extractor._get_server_flavor(server),
+        )
+
+    def test_embedded_flavors_not_supported(self):
+        """Test that flavors are listed if the API cannot embed them."""
+        self.flags(nova_embedded_flavors=True)
+        self.mocks["discover_version"].return_value = api_versions.APIVersion("2.46")
+        self.m_nova.flavors.list.reset_mock()
+        cache.reset()
+
+        extractor = nova.NovaExtractor("bar", "baz")
+        self.assertFalse(extractor.embedded_flavors)
+        self.assertTrue(self.m_nova.flavors.list.called)
+
+    def test_images_are_not_listed(self):
+        """Test that the image catalog is not listed when starting."""
+        self.assertFalse(self.m_glance.images.list.called)
+
+    def test_resolve_images(self):
+        """Test that only referenced images are requested, in batches."""
+        image = {"id": "foo", "vmcatcher_event_ad_mpuri": "https://foo"}
+        m_image = mock.MagicMock(id="foo")
+        m_image.get.side_effect = image.get
+        other = mock.MagicMock(id="bar")
+        other.get.return_value = None
+        self.m_glance.images.list.return_value = [m_image, other]
+
+        self.extractor._resolve_images(["foo", "bar", "baz", "foo"])
+        self.m_glance.images.list.assert_called_once_with(
+            filters={"id": "in:bar,baz,foo"}
+        )
+        self.assertEqual("https://foo", self.extractor._get_image("foo"))
+        self.assertEqual("bar", self.extractor._get_image("bar"))
+        self.assertIsNone(self.extractor._get_image("baz"))
+
+        # Everything is cached, also the missing image
+        self.extractor._resolve_images(["foo", "baz"])
+        self.m_glance.images.list.assert_called_once()
+        self.assertFalse(self.m_glance.images.get.called)
+
+    def test_resolve_images_without_filter(self):
+        """Test that images are requested one by one if we cannot filter."""
+        self.m_glance.images.list.side_effect = glanceclient.exc.HTTPBadRequest()
+        self.m_glance.images.get.side_effect = glanceclient.exc.HTTPNotFound()
+
+        self.extractor._resolve_images(["foo"])
+        self.m_glance.images.get.assert_called_once_with("foo")
+        self.assertIsNone(self.extractor._get_image("foo"))
+
+    def test_users_are_shared(self):
+        """Test that users are requested only once for all the extractors."""
+        self.m_keystone.users.get.return_value.name = "foo"
+        other = nova.NovaExtractor("bar", "baz")
+        self.assertEqual("foo", self.extractor.users["user-id"])
+        self.assertEqual("foo", other.users["user-id"])
+        self.m_keystone.users.get.assert_called_once_with(user="user-id")
+
+    def test_missing_users_are_cached(self):
+        """Test that users that cannot be found are not requested again."""
+        self.m_keystone.users.get.side_effect = keystoneauth1.exceptions.NotFound()
+        self.assertIsNone(self.extractor.users["user-id"])
+        self.assertIsNone(nova.NovaExtractor("bar", "baz").users["user-id"])
+        self.m_keystone.users.get.assert_called_once_with(user="user-id")
+
+    def test_users_not_cached_on_errors(self):
+        """Test that users are requested again after temporary errors."""
+        user = mock.MagicMock()
+        user.name = "foo"
+        self.m_keystone.users.get.side_effect = [
+            keystoneauth1.exceptions.ServiceUnavailable(),
+            user,
+        ]
+        self.assertIsNone(self.extractor.users["user-id"])
+        self.assertEqual("foo", self.extractor.users["user-id"])
+        self.assertEqual(2, self.m_keystone.users.get.call_count)
+
+    def test_prefetch_users(self):
+        """Test that users can be listed at once, per domain."""
+        self.flags(prefetch_users=True)
+        domain = mock.MagicMock(id="domain-id")
+        self.m_keystone.domains.list.return_value = [domain]
+        user = mock.MagicMock(id="user-id")
+        user.name = "foo"
+        self.m_keystone.users.list.return_value = [user]
+
+        extractor = nova.NovaExtractor("bar", "baz")
+        self.assertEqual("foo", extractor.users["user-id"])
+        self.m_keystone.users.list.assert_called_once_with(domain="domain-id")
+        self.assertFalse(self.m_keystone.users.get.called)
+
+    def test_all_tenants_servers(self):
+        """Test that servers are listed once for all the projects."""
+        self.flags(nova_all_tenants=True)
+        servers = [
+            mock.MagicMock(
+                id=f"server-{i}",
+                tenant_id=tenant_id,
+                created=f"2020-01-0{i + 1}T00:00:00Z",
+                updated=updated,
+            )
+            for i, (tenant_id, updated) in enumerate(
+                [
+                    ("foo", "2020-02-01T00:00:00Z"),
+                    ("bar", "2020-02-01T00:00:00Z"),
+                    ("foo", "2020-01-01T00:00:00Z"),
+                ]
+            )
+        ]
+        self.m_nova.servers.list.return_value = servers
+        self.extractor.project_id = "foo"
+        other = nova.NovaExtractor("bar", "baz")
+        other.project_id = "bar"
+
+        extract_from = datetime.datetime(2020, 1, 15)
+        self.assertEqual([servers[0]], self.extractor._get_servers(extract_from))
+        self.assertEqual([servers[1]], other._get_servers(extract_from))
+        self.m_nova.servers.list.assert_called_once_with(
+            search_opts={"changes-since": extract_from, "all_tenants": True},
+            limit=200,
+            marker=None,
+        )
+
+        # An older date needs a new listing
+        extract_from = datetime.datetime(2019, 1, 1)
+        self.assertEqual(
+            [servers[0], servers[2]], self.extractor._get_servers(extract_from)
+        )
+        self.assertEqual(2, self.m_nova.servers.list.call_count)
+
+    def test_all_tenants_usages(self):
+        """Test that usages are requested once for all the projects."""
+        self.flags(nova_all_tenants_usages=True)
+        self.mocks["discover_version"].return_value = api_versions.APIVersion("2.40")
+        cache.reset()
+        usages = [
+            {"instance_id": "server-1", "ended_at": None},
+            {"instance_id": "server-2", "ended_at": "2019-01-01T00:00:00.000000"},
+        ]
+        self.m_nova.usage.list.return_value = [
+            mock.MagicMock(tenant_id="foo", server_usages=usages),
+            mock.MagicMock(tenant_id="bar", server_usages=[]),
+        ]
+        self.extractor.project_id = "foo"
+        other = nova.NovaExtractor("bar", "baz")
+        other.project_id = "bar"
+
+        start = datetime.datetime(2020, 1, 1)
+        end = datetime.datetime(2020, 2, 1)
+        self.assertEqual([usages[0]], self.extractor._get_usages(start, end))
+        self.assertEqual([], other._get_usages(start, end))
+        self.m_nova.usage.list.assert_called_once_with(
+            start, end, detailed=True, marker=None, limit=200
+        )
+        self.assertFalse(self.m_nova.usage.get.called)
+
+    def test_all_tenants_usages_not_used_with_windows(self):
+        """Test that usages are requested per project in backfill mode."""
+        self.flags(nova_all_tenants_usages=True)
+        self.flags(backfill_window="month")
+        self.mocks["discover_version"].return_value = api_versions.APIVersion("2.39")
+        cache.reset()
+        self.m_nova.usage.get.return_value = mock.MagicMock(server_usages=[])
+        self.extractor.project_id = "foo"
+
+        start = datetime.datetime(2020, 1, 1)
+        end = datetime.datetime(2020, 2, 1)
+        self.assertEqual([], list(self.extractor._get_usages(start, end)))
+        self.m_nova.usage.get.assert_called_once_with("foo", start, end)
+        self.assertFalse(self.m_nova.usage.list.called)
+
+    def test_usages_are_paginated(self):
+        """Test that usages for a project are requested page by page."""
+        usages = [{"instance_id": f"server-{i}"} for i in range(201)]
+        self.m_nova.usage.get.side_effect = [
+            mock.MagicMock(server_usages=usages[:200]),
+            mock.MagicMock(server_usages=usages[200:]),
+        ]
+        self.extractor.project_id = "foo"
+
+        start = datetime.datetime(2020, 1, 1)
+        end = datetime.datetime(2020, 2, 1)
+        self.assertEqual(usages, list(self.extractor._get_usages(start, end)))
+        self.m_nova.usage.get.assert_has_calls(
+            [
+                mock.call("foo", start, end, marker=None, limit=200),
+                mock.call("foo", start, end, marker="server-199", limit=200),
+            ]
+        )
+
+    def test_usages_without_pagination(self):
+        """Test that usages are requested at once on old compute APIs."""
+        self.mocks["discover_version"].return_value = api_versions.APIVersion("2.39")
+        cache.reset()
+        usages = [{"instance_id": "server-1"}]
+        self.m_nova.usage.get.return_value = mock.MagicMock(server_usages=usages)
+        self.extractor.project_id = "foo"
+
+        start = datetime.datetime(2020, 1, 1)
+        end = datetime.datetime(2020, 2, 1)
+        self.assertEqual(usages, list(self.extractor._get_usages(start, end)))
+        self.m_nova.usage.get.assert_called_once_with("foo", start, end)
+
+    def test_load_servers(self):
+        """Test that servers are requested concurrently, skipping errors."""
+        server = mock.MagicMock(id="foo", image={"id": "image-id"})
+        self.m_glance.images.list.return_value = []
+
+        def get(server_id):
+            if server_id == "foo":
+                return server
+            raise novaclient.exceptions.NotFound(404)
+
+        self.m_nova.servers.get.side_effect = get
+        servers = self.extractor._load_servers({"foo": {}, "bar": {}})
+        self.assertEqual({"foo": server}, servers)
+        self.assertEqual(2, self.m_nova.servers.get.call_count)
+        self.m_glance.images.list.assert_called_once_with(filters={"id": "in:image-id"})
+
+    def test_load_servers_cached(self):
+        """Test that unchanged servers are taken from the persistent cache."""
+        self.flags(servers_ttl=3600, group="cache")
+        server = mock.MagicMock(id="foo", image={})
+        server.to_dict.return_value = {"id": "foo", "name": "bar", "image": {}}
+        self.m_nova.servers.get.return_value = server
+        usage = {"state": "active", "flavor": "m1.small", "ended_at": None}
+
+        self.extractor._load_servers({"foo": usage})
+        servers = self.extractor._load_servers({"foo": dict(usage)})
+        self.assertEqual(1, self.m_nova.servers.get.call_count)
+        self.assertEqual("bar", servers["foo"].name)
+
+        # The server changed, so it is requested again
+        servers = self.extractor._load_servers({"foo": dict(usage, state="deleted")})
+        self.assertEqual(2, self.m_nova.servers.get.call_count)
+        self.assertEqual(server, servers["foo"])
+
+        # The cached server expired, so it is requested again
+        usage = dict(usage, state="deleted")
+        with mock.patch("time.time", return_value=time.time() + 7200):
+            self.extractor._load_servers({"foo": usage})
+        self.assertEqual(3, self.m_nova.servers.get.call_count)
+
+    def test_process_usages_loads_missing_servers_in_batches(self):
+        """Test that missing servers are collected before requesting them."""
+        self.extractor.records = {"server-0": mock.MagicMock()}
+        usages = [{"instance_id": f"server-{i}"} for i in range(3)]
+        with mock.patch.object(self.extractor, "_load_servers") as m_load:
+            with mock.patch.object(self.extractor, "_process_usages_batch") as m_proc:
+                m_proc.return_value = ({}, {})
+                list(
+                    self.extractor._process_usages_for_period(iter(usages), None, None)
+                )
+        m_load.assert_called_once_with({"server-1": usages[1], "server-2": usages[2]})
+        m_proc.assert_called_once_with(usages, m_load.return_value, None, None)
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for `caso.cache` module."""
+
+import os
+
+import fixtures
+import mock
+
+from caso import cache
+from caso.tests import base
+
+cache.CONF.import_opt("spooldir", "caso.manager")
+
+
+class TestCache(base.TestCase):
+    """Test case for the caches shared by the extractors."""
+
+    def setUp(self):
+        """Run before each test method to initialize test environment."""
+        super(TestCache, self).setUp()
+        self.spooldir = self.useFixture(fixtures.TempDir()).path
+        self.flags(spooldir=self.spooldir)
+        self.cache = cache.Cache("flavors")
+        self.addCleanup(cache._CACHES.remove, self.cache)
+
+    def tearDown(self):
+        """Run after each test, reset state and environment."""
+        self.reset_flags()
+
+        super(TestCache, self).tearDown()
+
+    def test_populate_once(self):
+        """Test that the cache is only populated once per run."""
+        loader = mock.Mock(return_value={"foo": "bar"})
+        self.cache.populate(loader)
+        self.cache.populate(loader)
+        loader.assert_called_once_with()
+        self.assertEqual("bar", self.cache.get("foo"))
+
+        cache.reset()
+        self.cache.populate(loader)
+        self.assertEqual(2, loader.call_count)
+
+    def test_get_caches_missing_values(self):
+        """Test that missing values are also cached."""
+        loader = mock.Mock(return_value=None)
+        self.assertIsNone(self.cache.get("foo", loader))
+        self.assertIsNone(self.cache.get("foo", loader))
+        loader.assert_called_once_with("foo")
+
+    def test_not_persistent(self):
+        """Test that caches are not stored if there is no TTL."""
+        self.cache.populate(lambda: {"foo": "bar"})
+        cache.flush()
+        self.assertFalse(os.path.exists(self.cache.path))
+
+    def test_persistent(self):
+        """Test that persistent caches are reused until they expire."""
+        self.flags(flavors_ttl=100, group="cache")
+        loader = mock.Mock(return_value={"foo": "bar", "baz": "bazonk"})
+        with mock.patch("time.time", return_value=1000):
+            self.cache.populate(loader)
+            cache.flush()
+
+            cache.reset()
+            self.cache.populate(loader)
+            loader.assert_called_once_with()
+            self.assertEqual("bar", self.cache.get("foo"))
+
+        # Expired, "baz" is not listed anymore but it is kept
+        loader.return_value = {"foo": "bar"}
+        with mock.patch("time.time", return_value=2000):
+            cache.reset()
+            self.cache.populate(loader)
+            self.assertEqual(2, loader.call_count)
+            self.assertEqual("bazonk", self.cache.get("baz", lambda key: None))
+
+    def test_reset_keeps_persistent_caches(self):
+        """Test that persistent caches are kept warm between runs."""
+        self.flags(flavors_ttl=3600, group="cache")
+        loader = mock.Mock(return_value={"foo": "bar"})
+        self.cache.populate(loader)
+
+        with mock.patch("os.path.exists") as m_exists:
+            cache.reset()
+            self.cache.populate(loader)
+            self.assertFalse(m_exists.called)
+        loader.assert_called_once_with()
+
+    def test_memory_ttl(self):
+        """Test that caches are kept in memory between runs if set."""
+        self.flags(memory_ttl=100, group="cache")
+        loader = mock.Mock(return_value={"foo": "bar"})
+        with mock.patch("time.time", return_value=1000):
+            self.cache.populate(loader)
+            cache.flush()
+            self.assertFalse(os.path.exists(self.cache.path))
+
+            cache.reset()
+            self.cache.populate(loader)
+            loader.assert_called_once_with()
+
+        with mock.patch("time.time", return_value=1200):
+            cache.reset()
+            cache.flush()
+            self.assertEqual({}, self.cache._data)
+            self.cache.populate(loader)
+            self.assertEqual(2, loader.call_count)
+
+    def test_expired_entries_dropped(self):
+        """Test that expired entries are misses and are not stored again."""
+        self.flags(flavors_ttl=100, group="cache")
+        with mock.patch("time.time", return_value=1000):
+            self.cache.update({"foo": "bar"})
+        with mock.patch("time.time", return_value=1050):
+            self.cache.update({"baz": "bazonk"})
+            cache.flush()
+
+        with mock.patch("time.time", return_value=1120):
+            self.assertIsNone(self.cache.get("foo"))
+            self.assertEqual("bazonk", self.cache.get("baz"))
+            cache.flush()
+
+        self.cache.clear()
+        with mock.patch("time.time", return_value=1120):
+            self.assertEqual({"baz": "bazonk"}, self.cache.items())
+            self.assertNotIn("foo", self.cache._data)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for `caso._cmd.daemon` module."""
+
+import threading
+
+import mock
+
+from caso._cmd import daemon
+from caso.tests import base
+
+
+class TestServe(base.TestCase):
+    """Test case for the loop of the cASO daemon."""
+
+    def setUp(self):
+        """Run before each test method to initialize test environment."""
+        super(TestServe, self).setUp()
+        self.manager = mock.MagicMock()
+        self.stop = mock.MagicMock()
+
+    def tearDown(self):
+        """Run after each test, reset state and environment."""
+        self.reset_flags()
+
+        super(TestServe, self).tearDown()
+
+    def test_survives_failing_runs(self):
+        """Test that a failing run does not stop the daemon."""
+        self.stop.is_set.side_effect = [False, False, True]
+        self.manager.run.side_effect = [Exception("bazonk"), None]
+
+        daemon.serve(self.manager, self.stop)
+
+        self.assertEqual(2, self.manager.run.call_count)
+        self.assertEqual(2, self.stop.wait.call_count)
+
+    def test_honours_stop(self):
+        """Test that no run is started once stop is set."""
+        stop = threading.Event()
+        stop.set()
+
+        daemon.serve(self.manager, stop)
+
+        self.assertFalse(self.manager.run.called)
+
+    def test_waits_interval(self):
+        """Test that runs start every interval, minus the time they take."""
+        self.flags(interval=600, group="daemon")
+        self.stop.is_set.side_effect = [False, False, True]
+
+        with mock.patch("time.monotonic", side_effect=[0, 100, 1000, 1800]):
+            daemon.serve(self.manager, self.stop)
+
+        # The second run took longer than the interval, no wait at all
+        self.assertEqual([mock.call(500), mock.call(0)], self.stop.wait.call_args_list)
+
+
+class TestSetDefaults(base.TestCase):
+    """Test case for the defaults of the cASO daemon."""
+
+    def tearDown(self):
+        """Run after each test, reset state and environment."""
+        daemon.CONF.set_default("memory_ttl", 0, group="cache")
+        self.reset_flags()
+
+        super(TestSetDefaults, self).tearDown()
+
+    def test_caches_kept_in_memory(self):
+        """Test that the caches are kept between runs by default."""
+        daemon.set_defaults()
+        self.assertEqual(daemon.MEMORY_TTL, daemon.CONF.cache.memory_ttl)
+
+        self.flags(interval=86400, group="daemon")
+        daemon.set_defaults()
+        self.assertEqual(2 * 86400, daemon.CONF.cache.memory_ttl)
+
+    def test_memory_ttl_set(self):
+        """Test that a configured memory_ttl is kept."""
+        self.flags(memory_ttl=0, group="cache")
+        daemon.set_defaults()
+        self.assertEqual(0, daemon.CONF.cache.memory_ttl)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for `caso.keystone_client` module."""
+
+import json
+import os
+import stat
+
+import fixtures
+import mock
+
+from caso import cache
+from caso import keystone_client
+from caso.tests import base
+
+keystone_client.CONF.import_opt("spooldir", "caso.manager")
+
+
+class TestKeystoneClient(base.TestCase):
+    """Test case for the Keystone session and client management."""
+
+    def setUp(self):
+        """Run before each test method to initialize test environment."""
+        super(TestKeystoneClient, self).setUp()
+        self.p_sessions = mock.patch.dict(keystone_client._SESSIONS, clear=True)
+        self.p_sessions.start()
+        self.p_states = mock.patch.dict(keystone_client._AUTH_STATES, clear=True)
+        self.p_states.start()
+        self.p_auth = mock.patch("keystoneauth1.loading.load_auth_from_conf_options")
+        self.m_auth = self.p_auth.start()
+        self.p_sess = mock.patch("keystoneauth1.loading.load_session_from_conf_options")
+        self.m_sess = self.p_sess.start()
+
+    def tearDown(self):
+        """Run after each test, reset state and environment."""
+        self.p_auth.stop()
+        self.p_sess.stop()
+        self.p_sessions.stop()
+        self.p_states.stop()
+        self.reset_flags()
+
+        super(TestKeystoneClient, self).tearDown()
+
+    def test_get_session_is_shared(self):
+        """Test that sessions are created only once per project and scope."""
+        sess = keystone_client.get_session(keystone_client.CONF, "foo")
+        self.assertIs(sess, keystone_client.get_session(keystone_client.CONF, "foo"))
+        self.m_sess.assert_called_once()
+        sess.get_token.assert_called_once_with()
+
+        keystone_client.get_session(keystone_client.CONF, "foo", system_scope="all")
+        self.assertEqual(2, self.m_sess.call_count)
+
+    def test_sessions_share_http_session(self):
+        """Test that all sessions share the same HTTP connection pool."""
+        sess = keystone_client.get_session(keystone_client.CONF, "foo")
+        keystone_client.get_session(keystone_client.CONF, "bar")
+        self.assertEqual(sess.session, self.m_sess.call_args_list[1][1]["session"])
+
+    def test_save_and_load_state(self):
+        """Test that the auth state is persisted and restored."""
+        spooldir = self.useFixture(fixtures.TempDir()).path
+        self.flags(spooldir=spooldir)
+        self.flags(cache_auth_state=True, group="keystone_auth")
+
+        auth_state = json.dumps(
+            {
+                "auth_token": "foo",
+                "body": {"token": {"expires_at": "2999-12-31T00:00:00Z"}},
+            }
+        )
+        expired_state = json.dumps(
+            {
+                "auth_token": "bar",
+                "body": {"token": {"expires_at": "1999-12-31T00:00:00Z"}},
+            }
+        )
+        sess = mock.MagicMock()
+        sess.auth.get_cache_id.return_value = "valid"
+        sess.auth.get_auth_state.return_value = auth_state
+        keystone_client._SESSIONS[("foo", None)] = sess
+        keystone_client._AUTH_STATES["expired"] = expired_state
+
+        keystone_client.save_state(keystone_client.CONF)
+
+        state_file = os.path.join(spooldir, "keystone", "state.json")
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(state_file).st_mode))
+        with open(state_file) as fd:
+            self.assertEqual({"valid": auth_state}, json.load(fd)["auth"])
+
+        keystone_client._AUTH_STATES.clear()
+        with mock.patch.object(keystone_client, "_STATE_LOADED", False):
+            self.m_auth.return_value.get_cache_id.return_value = "valid"
+            keystone_client.get_session(keystone_client.CONF, "bar")
+        self.m_auth.return_value.set_auth_state.assert_called_once_with(auth_state)
+
+    def test_projects_listed_once(self):
+        """Test that all the projects are listed only once per run."""
+        client = mock.MagicMock()
+        project = mock.MagicMock(id="foo")
+        project.to_dict.return_value = {"id": "foo", "VO": "bar"}
+        client.projects.list.return_value = [project]
+        self.addCleanup(cache.reset)
+
+        self.assertEqual(
+            {"id": "foo", "VO": "bar"}, keystone_client.get_project(client, "foo")
+        )
+        self.assertIsNone(keystone_client.get_project(client, "bar"))
+        self.assertEqual(["foo"], list(keystone_client.get_projects(client)))
+        client.projects.list.assert_called_once_with()
+
+        cache.reset()
+        keystone_client.get_projects(client)
+        self.assertEqual(2, client.projects.list.call_count)
+
+    def test_restore_discover(self):
+        """Test that wrong discovery documents are discovered again."""
+        data = [
+            {
+                "id": "v3.14",
+                "status": "stable",
+                "links": [{"rel": "self", "href": "https://example.org/v3"}],
+            }
+        ]
+        disc = keystone_client._restore_discover("https://example.org", data)
+        self.assertEqual(data, disc.raw_version_data())
+        self.assertIsNone(
+            keystone_client._restore_discover("https://example.org", "bazonk")
+        )
@@ -18,9 +18,13 @@ import mock
 from oslo_concurrency.fixture import lockutils as lock_fixture
 import six
 
+import caso.extract.manager
 from caso import manager
 from caso.tests import base
 
+# The extractor manager is mocked in most tests
+ExtractorManager = caso.extract.manager.Manager
+
 
 class TestCasoManager(base.TestCase):
     """Test case for the cASO Manager."""
@@ -48,3 +52,157 @@ class TestCasoManager(base.TestCase):
             p.stop()
 
         super(TestCasoManager, self).tearDown()
+
+    def test_run_pushes_in_batches(self):
+        """Test that records are pushed in batches as they are extracted."""
+        self.flags(push_batch_size=2)
+        extractor_manager = self.mocks["extract"].return_value
+        extractor_manager.iter_records.return_value = iter(range(5))
+        messenger = self.mocks["messenger"].return_value
+
+        with mock.patch("caso.keystone_client.save_state"):
+            self.manager.run()
+
+        self.assertEqual(
+            [mock.call([0, 1]), mock.call([2, 3]), mock.call([4])],
+            messenger.push_to_all.call_args_list,
+        )
+
+    def test_run_writes_checkpoints_after_push(self):
+        """Test that last runs are only stored once their records are pushed."""
+        self.flags(push_batch_size=2)
+        checkpoints = [
+            caso.extract.manager.Checkpoint("foo", "mock", i) for i in range(3)
+        ]
+        extractor_manager = self.mocks["extract"].return_value
+        extractor_manager.iter_records.return_value = iter(
+            [0, checkpoints[0], 1, 2, checkpoints[1], 3, 4, checkpoints[2]]
+        )
+        messenger = self.mocks["messenger"].return_value
+        calls = mock.Mock()
+        calls.attach_mock(messenger.push_to_all, "push")
+        calls.attach_mock(extractor_manager.write_checkpoint, "checkpoint")
+        messenger.push_to_all.return_value = True
+
+        with mock.patch("caso.keystone_client.save_state"):
+            self.manager.run()
+
+        self.assertEqual(
+            [
+                mock.call.push([0, 1]),
+                mock.call.checkpoint(checkpoints[0], pushed=True),
+                mock.call.push([2, 3]),
+                mock.call.checkpoint(checkpoints[1], pushed=True),
+                mock.call.push([4]),
+                mock.call.checkpoint(checkpoints[2], pushed=True),
+            ],
+            calls.mock_calls,
+        )
+
+    def test_run_failed_push_skips_checkpoints(self):
+        """Test that no last run is stored once a push fails."""
+        self.flags(push_batch_size=2)
+        checkpoints = [
+            caso.extract.manager.Checkpoint("foo", "mock", i) for i in range(3)
+        ]
+        extractor_manager = self.mocks["extract"].return_value
+        extractor_manager.iter_records.return_value = iter(
+            [0, checkpoints[0], 1, 2, checkpoints[1], 3, 4, checkpoints[2]]
+        )
+        messenger = self.mocks["messenger"].return_value
+        # The messenger manager logs the errors and reports the failure
+        messenger.push_to_all.side_effect = [True, False, True]
+
+        with mock.patch("caso.keystone_client.save_state"):
+            self.manager.run()
+
+        self.assertEqual(3, messenger.push_to_all.call_count)
+        self.assertEqual(
+            [
+                mock.call(checkpoints[0], pushed=True),
+                mock.call(checkpoints[1], pushed=False),
+                mock.call(checkpoints[2], pushed=False),
+            ],
+            extractor_manager.write_checkpoint.call_args_list,
+        )
+
+    def test_run_releases_project_locks_after_push(self):
+        """Test that projects are locked until their last runs are stored."""
+        self.flags(lock_granularity="project")
+        self.flags(extractor=["mock"])
+        self.flags(projects=["foo"])
+        calls = mock.Mock()
+        m_extractor = mock.MagicMock()
+        m_extractor.return_value.iter_records.return_value = ["r1"]
+        with mock.patch("caso.loading.get_available_extractors") as m_available:
+            m_available.return_value = {"mock": m_extractor}
+            with mock.patch.object(ExtractorManager, "_get_keystone_client"):
+                extractor_manager = ExtractorManager(lock_path="/var/lock/caso")
+        self.manager.extractor_manager = extractor_manager
+        self.manager.messenger = self.mocks["messenger"].return_value
+        self.manager.messenger.push_to_all = calls.push
+        calls.push.return_value = True
+        lock = calls.lock
+        lock.acquire.return_value = True
+
+        with mock.patch("oslo_concurrency.lockutils.external_lock") as m_lock:
+            m_lock.return_value = lock
+            with mock.patch.object(extractor_manager, "write_lastrun") as m_write:
+                calls.attach_mock(m_write, "write_lastrun")
+                with mock.patch("caso.keystone_client.save_state"):
+                    self.manager.run()
+
+        self.assertEqual(
+            [
+                mock.call.lock.acquire(blocking=False),
+                mock.call.push(["r1"]),
+                mock.call.write_lastrun("foo", mock.ANY, extractor="mock"),
+                mock.call.lock.release(),
+            ],
+            calls.mock_calls,
+        )
+
+    def test_run_dry_run(self):
+        """Test that records are extracted but not pushed on dry run."""
+        self.flags(dry_run=True)
+        extractor_manager = self.mocks["extract"].return_value
+        records = iter(range(5))
+        extractor_manager.iter_records.return_value = records
+        messenger = self.mocks["messenger"].return_value
+
+        with mock.patch("caso.keystone_client.save_state"):
+            self.manager.run()
+
+        self.assertFalse(messenger.push_to_all.called)
+        self.assertEqual([], list(records))
+
+    def test_run_sharded_lock(self):
+        """Test that each shard takes its own lock."""
+        self.flags(shard_count=4)
+        self.flags(shard_index=1)
+        extractor_manager = self.mocks["extract"].return_value
+        extractor_manager.iter_records.return_value = iter([])
+
+        with mock.patch("caso.keystone_client.save_state"):
+            with mock.patch("oslo_concurrency.lockutils.synchronized") as m:
+                m.return_value = lambda f: f
+                self.manager.run()
+
+        m.assert_called_once_with(
+            "caso_should_not_run_in_parallel_shard_1_of_4",
+            lock_path=mock.ANY,
+            external=True,
+        )
+
+    def test_run_project_locks(self):
+        """Test that the global lock is not taken if projects are locked."""
+        self.flags(lock_granularity="project")
+        extractor_manager = self.mocks["extract"].return_value
+        extractor_manager.iter_records.return_value = iter([])
+
+        with mock.patch("caso.keystone_client.save_state"):
+            with mock.patch("oslo_concurrency.lockutils.synchronized") as m:
+                self.manager.run()
+
+        self.assertFalse(m.called)
+        self.mocks["extract"].assert_called_once_with(lock_path=mock.ANY)
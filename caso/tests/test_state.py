@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Tests for `caso.state` module."""
+
+import os
+
+import fixtures
+
+from caso import state
+from caso.tests import base
+
+
+class TestSQLiteStore(base.TestCase):
+    """Test case for the SQLite state store."""
+
+    def setUp(self):
+        """Run before each test method to initialize test environment."""
+        super(TestSQLiteStore, self).setUp()
+        self.spooldir = self.useFixture(fixtures.TempDir()).path
+        self.path = os.path.join(self.spooldir, "state.db")
+        self.base = os.path.join(self.spooldir, "lastrun")
+
+    def _write(self, name, data):
+        with open(f"{self.base}.{name}", "w") as fd:
+            fd.write(data)
+
+    def test_set_and_get(self):
+        """Test that dates are stored and read back when opening the store."""
+        store = state.SQLiteStore(self.path)
+        self.assertIsNone(store.get("foo"))
+        store.set("foo", "2015-12-19")
+        store.set("foo", "2015-12-20", extractor="nova")
+
+        store = state.SQLiteStore(self.path)
+        self.assertEqual("2015-12-19", store.get("foo"))
+        self.assertEqual("2015-12-20", store.get("foo", "nova"))
+        self.assertIsNone(store.get("foo", "cinder"))
+
+    def test_refresh(self):
+        """Test that dates updated by other processes can be read again."""
+        store = state.SQLiteStore(self.path)
+        store.set("foo", "2015-12-19", extractor="nova")
+        other = state.SQLiteStore(self.path)
+        other.set("foo", "2015-12-20", extractor="nova")
+        other.set("bar", "2015-12-20", extractor="nova")
+
+        self.assertEqual("2015-12-19", store.get("foo", "nova"))
+        store.refresh("foo")
+        self.assertEqual("2015-12-20", store.get("foo", "nova"))
+        self.assertIsNone(store.get("bar", "nova"))
+
+    def test_import_files(self):
+        """Test that lastrun files are imported once, skipping wrong ones."""
+        self._write("foo", "2015-12-19 00:00:00+00:00")
+        self._write("foo.nova", "2015-12-20 00:00:00+00:00")
+        self._write("bar.baz", "2015-12-21 00:00:00+00:00")
+        self._write("broken", "bazonk")
+
+        store = state.SQLiteStore(self.path)
+        store.set("foo", "2016-01-01", extractor="nova")
+        store.import_files(self.base, {"nova"})
+
+        self.assertEqual("2015-12-19 00:00:00+00:00", store.get("foo"))
+        # Dates in the database are not overwritten
+        self.assertEqual("2016-01-01", store.get("foo", "nova"))
+        self.assertEqual("2015-12-21 00:00:00+00:00", store.get("bar.baz"))
+        self.assertIsNone(store.get("broken"))
+
+        # Files are only imported once
+        self._write("new", "2015-12-19 00:00:00+00:00")
+        store = state.SQLiteStore(self.path)
+        store.import_files(self.base, {"nova"})
+        self.assertIsNone(store.get("new"))
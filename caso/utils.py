@@ -19,6 +19,7 @@
 import errno
 import os
 import os.path
+import tempfile
 
 
 def makedirs(path):
@@ -36,3 +37,24 @@ def makedirs(path):
                 raise
         else:
             raise
+
+
+def write_file(path, data, mode=0o600):
+    """Atomically write data into a file with restricted permissions.
+
+    The data is written into a temporary file in the same directory, that is
+    then renamed to the final path, so that readers never see partial files.
+
+    :param path: File to write
+    :param data: String to write into the file
+    :param mode: Permissions for the file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise